@@ -1,21 +1,101 @@
-import pyproj
+import os
+import time
+import random
+import argparse
+import threading
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
+from pathlib import Path
 import geopandas as gpd
-import our_secrets
+from requests.adapters import HTTPAdapter
+import reprojection
+import traffic_store
+import streaming_json
+from traffic_aggregation import CubeAccumulator, HourlyAccumulator
 
-# Define the projection for the conversion
-geod = pyproj.Geod(ellps='WGS84')  # WGS84 ellipsoid, commonly used for GPS
+try:
+    from our_secrets import telraamApiKey
+except ImportError:
+    telraamApiKey = os.environ.get("TELRAAM_API_KEY", "")
 
-# Function to convert [lon, lat] to [x, y]
+API_URL = "https://telraam-api.net"
+DATA_FOLDER = Path(__file__).parent / 'segment_traffic_data'
+# Last report and running hourly sums per segment, so refreshes only fetch and aggregate new rows
+STATE_FILE = Path(__file__).parent / 'segment_fetch_state.json'
+
+# Seconds between saves of the fetch state during a run; a state older than a segment's file is detected by
+# update_segment, which then re-aggregates that segment's stored reports
+STATE_SAVE_INTERVAL = 30
+
+# Responses that are worth retrying after a pause
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Projected CRS the segment coordinates are stored in (ETRS89 / UTM zone 33N, metres, as used by Berlin's open data)
+PROJECTED_CRS = "EPSG:25833"
+
+# Function to convert [lon, lat] to [x, y]; takes scalars or arrays, so whole datasets convert in one call
 def convert_coordinates(lon, lat):
-    x, y, z = geod.fwd(lon, lat)
-    return x, y
+    return reprojection.transform_coordinates(lon, lat, "EPSG:4326", PROJECTED_CRS)
+
+class TokenBucket:
+    """Thread-safe token bucket that allows `rate` requests per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Function to create a session whose connection pool is shared by all worker threads
+def create_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers['X-Api-Key'] = telraamApiKey
+    return session
+
+# Function to send a request, retrying connection errors and retryable statuses with exponential backoff
+def request_with_retry(session, method, url, rate_limiter=None, retries=4, backoff=1.0, **kwargs):
+    for attempt in range(retries + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            response = session.request(method, url, timeout=60, **kwargs)
+        except requests.RequestException as e:
+            if attempt == retries:
+                print(f"Request to {url} failed: {str(e)}")
+                return None
+            delay = backoff * 2 ** attempt
+        else:
+            if response.status_code == 200:
+                return response
+            if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                print(f"Request to {url} failed with status {response.status_code}")
+                return None
+            retry_after = response.headers.get('Retry-After', '')
+            delay = float(retry_after) if retry_after.isdigit() else backoff * 2 ** attempt
+        time.sleep(delay + random.uniform(0, backoff))
+    return None
 
 # Function to fetch data for a single segment
-def fetch_segment_data(segment_id, start_time, end_time):
-    url = "https://telraam-api.net/v1/reports/traffic"
+def fetch_segment_data(segment_id, start_time, end_time, session=None, base_url=API_URL, rate_limiter=None):
+    url = f"{base_url}/v1/reports/traffic"
     body = {
         "level": "segments",
         "format": "per-hour",
@@ -23,81 +103,210 @@ def fetch_segment_data(segment_id, start_time, end_time):
         "time_start": start_time,
         "time_end": end_time
     }
-    headers = {
-        'X-Api-Key': our_secrets.telraamApiKey
-    }
-    response = requests.post(url, headers=headers, json=body)
-    return response.json() if response.status_code == 200 else None
+    session = session or create_session(1)
+    response = request_with_retry(session, "POST", url, rate_limiter=rate_limiter, json=body)
+    return response.json() if response is not None else None
 
 # Function to fetch segment coordinates from the GeoJSON file
 def fetch_segment_coordinates(geojson_url):
     try:
         # Load GeoJSON file
         segments = gpd.read_file(geojson_url)
-        
-        # Extract segment IDs and coordinates
-        segment_coords = {}
-        for idx, segment in segments.iterrows():
-            segment_id = segment['segment_id']
-            lon, lat = segment.geometry.centroid.x, segment.geometry.centroid.y
-            x, y = convert_coordinates(lon, lat)
-            segment_coords[segment_id] = [x, y]
-        
-        return segment_coords
+
+        # Extract segment IDs and convert all centroids at once
+        centroids = segments.geometry.centroid
+        x, y = convert_coordinates(centroids.x.to_numpy(), centroids.y.to_numpy())
+        return {segment_id: [sx, sy] for segment_id, sx, sy in zip(segments['segment_id'], x.tolist(), y.tolist())}
 
     except Exception as e:
         print(f"Error fetching segment coordinates: {str(e)}")
         return None
 
-# Function to process the fetched data
-def process_traffic_data(data):
-    hourly_traffic = {hour: {"car": [], "bike": [], "pedestrian": []} for hour in range(24)}
+# Function to write a segment's reports, going through a temporary file so an interrupted run never leaves a partial file
+def save_segment_data(data, segment_id, data_folder):
+    file_path = Path(data_folder) / f"{segment_id}.json"
+    temp_path = file_path.with_suffix('.json.tmp')
+    with open(temp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(temp_path, file_path)
+    return file_path
+
+def load_segment_data(segment_id, data_folder):
+    with open(Path(data_folder) / f"{segment_id}.json", 'r') as file:
+        return json.load(file)
+
+# Function to parse a Telraam timestamp such as "2024-03-28T00:00:00.000Z"
+def parse_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+def format_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def load_fetch_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as file:
+        return json.load(file)
+
+def save_fetch_state(state, state_path):
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(state, file)
+    os.replace(temp_path, state_path)
+
+# Function to merge freshly fetched reports into the stored ones and drop those older than window_start
+def merge_reports(stored_reports, new_reports, window_start):
+    """Returns the merged reports sorted by date, plus the reports that left and entered the averages."""
+    stored = {report['date']: report for report in stored_reports}
+    fresh = {report['date']: report for report in new_reports}
+    merged = {**stored, **fresh}
+
+    kept = [merged[date] for date in sorted(merged, key=parse_time) if parse_time(date) >= window_start]
+    # Stored rows leave the averages when a newer copy replaces them or they fall out of the window
+    removed = [report for date, report in stored.items() if date in fresh or parse_time(date) < window_start]
+    added = [report for date, report in fresh.items() if parse_time(date) >= window_start]
+    return kept, removed, added
 
-    for report in data.get('report', []):
-        dt = datetime.fromisoformat(report['date'].replace("Z", "+00:00"))
-        hour = dt.hour
-        hourly_traffic[hour]["car"].append(report['car'])
-        hourly_traffic[hour]["bike"].append(report['bike'])
-        hourly_traffic[hour]["pedestrian"].append(report['pedestrian'])
+# Function to bring one segment's stored reports and hourly averages up to date
+def update_segment(segment_id, entry, now, days, data_folder, session=None, base_url=API_URL, rate_limiter=None):
+    """Fetches only the reports after the segment's last stored one and keeps a rolling window of `days`.
 
-    averages = {hour: {
-        "avg_car": sum(values["car"]) / len(values["car"]) if values["car"] else 0,
-        "avg_bike": sum(values["bike"]) / len(values["bike"]) if values["bike"] else 0,
-        "avg_pedestrian": sum(values["pedestrian"]) / len(values["pedestrian"]) if values["pedestrian"] else 0
-    } for hour, values in hourly_traffic.items()}
+    entry is the segment's state from the previous run ({"last_report", "report_count", "sums", "counts"}) or None.
+    The running sums and counts are updated with the added and evicted rows instead of re-aggregating the window.
+    Returns the new entry, or None if the request failed.
+    """
+    file_path = Path(data_folder) / f"{segment_id}.json"
+    stored = load_segment_data(segment_id, data_folder) if file_path.exists() else None
+    stored_reports = (stored or {}).get('report', [])
+    window_start = now - timedelta(days=days)
 
-    return averages
+    # The state is only trusted if it still describes the file, e.g. after an interrupted run it may not
+    if entry and stored_reports and entry["last_report"] == stored_reports[-1]['date'] and entry["report_count"] == len(stored_reports):
+        accumulator = HourlyAccumulator.from_state(entry)
+    else:
+        accumulator = HourlyAccumulator().add(stored_reports)
+
+    start = window_start
+    if stored_reports:
+        start = max(window_start, parse_time(stored_reports[-1]['date']) + timedelta(hours=1))
+
+    new_reports = []
+    if start < now:
+        data = fetch_segment_data(segment_id, format_time(start), format_time(now), session, base_url, rate_limiter)
+        if data is None:
+            return None
+        new_reports = data.get('report', [])
+        stored = stored or data
+
+    reports, removed, added = merge_reports(stored_reports, new_reports, window_start)
+    accumulator.remove(removed).add(added)
+    if new_reports or removed:
+        stored['report'] = reports
+        save_segment_data(stored, segment_id, data_folder)
+
+    return {
+        "last_report": reports[-1]['date'] if reports else None,
+        "report_count": len(reports),
+        **accumulator.to_state()
+    }
+
+# Function to rebuild a segment's traffic cube from its stored window, streamed from disk in chunks
+def segment_cube(segment_id, data_folder):
+    cube = CubeAccumulator()
+    for reports in streaming_json.iter_chunks(streaming_json.iter_reports(Path(data_folder) / f"{segment_id}.json")):
+        cube.add(reports)
+    return cube.cube()
 
 # Function to fetch and process data for all segments
-def fetch_and_process_all_segments():
-    end_time = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-    start_time = (datetime.now(timezone.utc) - timedelta(days=90)).strftime("%Y-%m-%dT%H:%M:%SZ")
-    
+def fetch_and_process_all_segments(data_folder=DATA_FOLDER, base_url=API_URL, max_workers=4, requests_per_second=1.0, days=90, state_path=STATE_FILE, full=False):
+    """Brings every segment's reports up to date concurrently, writing each one to data_folder as it arrives.
+
+    Only the interval after a segment's last stored report is requested, so daily refreshes and runs resumed
+    after an interruption fetch a few rows per segment. full=True discards the stored reports and state and
+    downloads the whole window again. All requests share one connection pool and one token bucket rate limit.
+
+    The result covers every segment in the fetch state, also those this run did not list or failed to update,
+    so a refresh that goes wrong leaves the data of the previous one in place. It is empty when the segment
+    list could not be fetched.
+    """
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    Path(data_folder).mkdir(parents=True, exist_ok=True)
+    state = {} if full else load_fetch_state(state_path)
+
+    session = create_session(max_workers)
+    rate_limiter = TokenBucket(requests_per_second, capacity=max_workers)
+
     # Fetch segment IDs and coordinates from Telraam API
-    url = "https://telraam-api.net/v1/segments/all"
-    headers = {
-        'X-Api-Key': our_secrets.telraamApiKey
-    }
-    response = requests.get(url, headers=headers)
-    segments_data = response.json() if response.status_code == 200 else None
+    response = request_with_retry(session, "GET", f"{base_url}/v1/segments/all", rate_limiter=rate_limiter)
+    segments_data = response.json() if response is not None else None
 
     if not segments_data:
+        print("Could not fetch the segment list, nothing was updated")
         return {}
 
-    all_segments_data = {}
+    coordinates = {}
     for segment in segments_data['features']:
         segment_id = segment['properties']['oidn']
-        lon, lat = segment['geometry']['coordinates']
-        x, y = convert_coordinates(lon, lat)
-        data = fetch_segment_data(segment_id, start_time, end_time)
-        if data:
-            averages = process_traffic_data(data)
-            all_segments_data[segment_id] = {
-                "averages": averages,
-                "coordinates": [x, y]  # Store as [x, y] instead of [lon, lat]
-            }
-    
+        coordinates[segment_id] = segment['geometry']['coordinates']
+        if full and (Path(data_folder) / f"{segment_id}.json").exists():
+            os.remove(Path(data_folder) / f"{segment_id}.json")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(update_segment, segment_id, state.get(str(segment_id)), now, days, data_folder, session, base_url, rate_limiter): segment_id
+            for segment_id in coordinates
+        }
+        failed = 0
+        last_save = time.monotonic()
+        for future in as_completed(futures):
+            segment_id = futures[future]
+            try:
+                entry = future.result()
+            except Exception as e:
+                # One bad response must not abort the others; the segment keeps its previous state
+                print(f"Updating segment {segment_id} failed: {str(e)}")
+                entry = None
+            if entry:
+                # Kept in the state so the segment stays in the store on runs that do not list it
+                state[str(segment_id)] = {**entry, "coordinates": coordinates[segment_id]}
+            else:
+                failed += 1
+            if time.monotonic() - last_save >= STATE_SAVE_INTERVAL:
+                save_fetch_state(state, state_path)
+                last_save = time.monotonic()
+        save_fetch_state(state, state_path)
+        if failed:
+            print(f"{failed} of {len(futures)} segments could not be updated and keep their previous data")
+
+    # States written before the coordinates were kept only have them when the segment was listed this run
+    reported = [
+        segment_id for segment_id, entry in state.items()
+        if entry.get("report_count") and (entry.get("coordinates") or int(segment_id) in coordinates)
+    ]
+    lon, lat = zip(*(state[segment_id].get("coordinates") or coordinates[int(segment_id)] for segment_id in reported)) if reported else ((), ())
+    x, y = convert_coordinates(lon, lat)
+
+    all_segments_data = {}
+    for segment_id, sx, sy in zip(reported, x.tolist(), y.tolist()):
+        all_segments_data[segment_id] = {
+            "averages": HourlyAccumulator.from_state(state[segment_id]).averages(),
+            "cube": segment_cube(segment_id, data_folder),
+            "coordinates": [sx, sy]  # Store as [x, y] instead of [lon, lat]
+        }
+
     return all_segments_data
 
 if __name__ == '__main__':
-    fetch_and_process_all_segments()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Download the Telraam hourly reports of all segments.")
+    parser.add_argument("--base-url", default=API_URL, help="Telraam API root, e.g. a local stub server")
+    parser.add_argument("--data-folder", default=DATA_FOLDER, help="folder the per-segment JSON files are written to")
+    parser.add_argument("--workers", type=int, default=4, help="number of concurrent requests")
+    parser.add_argument("--rate", type=float, default=1.0, help="maximum requests per second")
+    parser.add_argument("--days", type=int, default=90, help="length of the rolling report window")
+    parser.add_argument("--full", action="store_true", help="re-download the whole window instead of only new reports")
+    args = parser.parse_args()
+
+    segments_data = fetch_and_process_all_segments(args.data_folder, args.base_url, args.workers, args.rate, args.days, full=args.full)
+    # An empty result would replace the store the app serves with one without any segment
+    if segments_data:
+        traffic_store.write_traffic_store(segments_data)
@@ -1,15 +1,20 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import os
-import geopandas as gpd
-import folium
-from streamlit_folium import st_folium
-from folium.plugins import HeatMap
-from pathlib import Path
-import json
+import base64
 from pyproj import Transformer
 import pandas as pd
 import get_crime
+import traffic_store
+import data_service
+import map_layers
+import map_cache
+import vector_tiles
+import instrumentation
+import artifacts
+
+# Records where the time of this rerun goes when BERLIN_MAP_TIMINGS is set
+timings = instrumentation.Timings()
 
 st.title("Berlin Safety Map")
 
@@ -33,59 +38,58 @@ with st.expander("About this Project", expanded=False):
     For more technical details, visit our GitHub repository(https://github.com/Kamilla-23/Map).
     """)
 
-# Cache the function for loading district boundaries
-@st.cache_data
-def load_districts(file_path):
-    return gpd.read_file(file_path)
-
-# Cache the function for loading streetlight GeoJSON
-@st.cache_data
-def load_streetlights(file_path):
-    return gpd.read_file(file_path)
-
-# Cache the function for loading traffic data from GeoJSON file
-@st.cache_data
-def load_traffic_geojson(file_path):
-    with open(file_path, 'r') as file:
-        return json.load(file)
-
-# Cache the function for loading traffic data
-@st.cache_data
-def load_traffic_data(file_path):
-    with open(file_path, 'r') as file:
-        return json.load(file)
-
-# Cache the function for loading police precincts GeoJSON
+# Resolve the build of artifacts.py this process serves once, so a newer build swapped in later is only
+# picked up by a restart and never mixed with this one
+@st.cache_resource
+def get_artifacts_dir():
+    return artifacts.current()
+
+# Share one lazily loading data service between all sessions, warming the heavy datasets up in the background.
+# Workers started by deploy/run_workers.sh read the read-only artifacts instead.
+@st.cache_resource
+def get_data_service():
+    service = data_service.DataService(get_artifacts_dir())
+    service.warm_up()
+    return service
+
+# Share one bounded cache of rendered maps between all sessions, backed by pages pre-rendered with map_cache.py
+# or, when they have been built, by the pages in the artifacts
+@st.cache_resource
+def get_map_cache():
+    if get_artifacts_dir() is not None:
+        return map_cache.MapCache(maxsize=128, directory=get_artifacts_dir() / artifacts.RENDERED_MAPS_DIR)
+    return map_cache.MapCache(maxsize=128, directory=map_cache.RENDERED_MAPS_DIR / map_cache.data_version())
+
+# Inline the sidebar image, so the page needs no media file that only the worker of this session holds
 @st.cache_data
-def load_police_precincts(file_path):
-    return gpd.read_file(file_path)
+def image_data_url(file_path):
+    with open(file_path, 'rb') as file:
+        return "data:image/png;base64," + base64.b64encode(file.read()).decode()
 
-# Load district boundaries
-districts_file = Path(__file__).parent / 'bezirksgrenzen.geojson'
-districts = load_districts(districts_file)
+# Serve the totals of all reruns in the Prometheus text format when BERLIN_MAP_METRICS_PORT is set
+@st.cache_resource
+def start_metrics_server():
+    return instrumentation.start_metrics_server()
 
-# Load streetlight GeoJSON
-streetlights_file = Path(__file__).parent / 'pruned_streetlight.geojson'
-streetlights = load_streetlights(streetlights_file)
+start_metrics_server()
 
-# Load traffic data GeoJSON
-traffic_file = Path(__file__).parent / 'converted_telraam_segments.geojson'
-traffic_coordinates = load_traffic_geojson(traffic_file)
+data = get_data_service()
 
-# Load segment traffic data
-segment_file = Path(__file__).parent / 'fetched_segments_data.json'
-segment_data = load_traffic_data(segment_file)
+# Load district boundaries, the only dataset every map needs
+with timings.measure("load_districts") as measurement:
+    districts = data.districts
+    measurement.features = len(districts)
 
-# Load police precincts GeoJSON
-police_precincts_file = Path(__file__).parent / 'converted_police_precincts.geojson'
-police_precincts = load_police_precincts(police_precincts_file)
-
-crime_data = get_crime.load_and_process_crime_data()
+# Links like ?district=Mitte&layer=Traffic+Data&hour=8 open the page with that map selected
+district_names = list(districts['Gemeinde_name'].unique())
+query_district = st.query_params.get("district")
+query_layer = st.query_params.get("layer")
+query_hour = st.query_params.get("hour", "")
 
 # Streamlit sidebar options
 st.sidebar.title("Map Options")
-selected_district = st.sidebar.selectbox("Choose a District", districts['Gemeinde_name'].unique())
-selected_layer = st.sidebar.selectbox("Select Layer", ["Crime Heat Map", "Crime Data", "Traffic Data", "Streetlights", "Police Precincts"])
+selected_district = st.sidebar.selectbox("Choose a District", district_names, index=district_names.index(query_district) if query_district in district_names else 0)
+selected_layer = st.sidebar.selectbox("Select Layer", map_layers.LAYERS, index=map_layers.LAYERS.index(query_layer) if query_layer in map_layers.LAYERS else 0)
 
 # Add descriptions for each layer
 layer_descriptions = {
@@ -98,15 +102,33 @@ layer_descriptions = {
 
 st.sidebar.write(layer_descriptions[selected_layer])
 
-district = districts[districts['Gemeinde_name'] == selected_district]
+selected_hour = selected_year = selected_crime_type = None
+selected_weekdays = selected_weeks = None
 
 if selected_layer == "Traffic Data":
-    selected_hour = st.sidebar.slider("Choose an Hour", min_value=0, max_value=23)
+    selected_hour = st.sidebar.slider("Choose an Hour", min_value=0, max_value=23, value=int(query_hour) if query_hour.isdigit() and int(query_hour) in map_layers.HOURS else 0)
+
+    # Narrow the averages down to some days of the week or a range of weeks, answered from the precomputed cube
+    segment_data = data.segment_data
+    if segment_data.has_cube:
+        day_names = st.sidebar.multiselect("Days of the Week", traffic_store.DAYS_OF_WEEK, default=traffic_store.DAYS_OF_WEEK)
+        if day_names and len(day_names) < len(traffic_store.DAYS_OF_WEEK):
+            selected_weekdays = tuple(sorted(traffic_store.DAYS_OF_WEEK.index(day) for day in day_names))
+
+        weeks = [str(week) for week in segment_data.weeks]
+        if len(weeks) > 1:
+            first_week, last_week = st.sidebar.select_slider("Weeks Starting", options=weeks, value=(weeks[0], weeks[-1]))
+            if (first_week, last_week) != (weeks[0], weeks[-1]):
+                selected_weeks = (first_week, last_week)
 
 if selected_layer == "Crime Data" or selected_layer == "Crime Heat Map":
+    with timings.measure("load_crime_data") as measurement:
+        crime_data = data.crime_data
+        measurement.features = len(crime_data)
     crime_data_in_district = crime_data[crime_data['Gemeinde_name'] == selected_district]
     if crime_data_in_district.empty:
         st.error(f"No crime data available for {selected_district}")
+        st.stop()
     else:
         #selected_year = st.sidebar.selectbox("Choose a Year", crime_data_in_district["Jahr"].unique())
         selected_year = st.sidebar.slider("Choose a Year", int(crime_data_in_district["Jahr"].min()), int(crime_data_in_district["Jahr"].max()), step=1)
@@ -128,7 +150,7 @@ if selected_layer == "Crime Data" or selected_layer == "Crime Heat Map":
             alias_to_crime_type = {v: k for k, v in crime_type_aliases.items()}
 
             # Create a list of English aliases for the selectbox
-            crime_types = [crime_type_aliases[col] for col in crime_data.columns.drop(['Gemeinde_name', 'Jahr', 'geometry'])]
+            crime_types = [crime_type_aliases[col] for col in get_crime.CRIME_TYPES]
 
             # Add selectbox to sidebar with English aliases
             selected_crime_type_alias = st.sidebar.selectbox("Choose a Crime Type", crime_types)
@@ -136,137 +158,45 @@ if selected_layer == "Crime Data" or selected_layer == "Crime Heat Map":
             # Get the corresponding German column name
             selected_crime_type = alias_to_crime_type[selected_crime_type_alias]
 
-# Create a base map
-
-if selected_layer == "Crime Heat Map":
-    bounds = districts.total_bounds 
-    m = folium.Map(
-        location=[(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2],  # Center of the bounds
-        zoom_start=10  
-    )
-    # Add all district boundaries to the map
-    folium.GeoJson(districts).add_to(m)
-else:
-    bounds = district.total_bounds  
-    m = folium.Map(
-        location=[(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2],  
-        zoom_start=12
-    )
-    folium.GeoJson(district).add_to(m)
-
-
-# Add the selected layer to the map
-if selected_layer == "Crime Heat Map":
-    
-    # Prepare data for the heat map
-    filtered_crime_data = crime_data[(crime_data["Jahr"] == selected_year) & (crime_data[selected_crime_type] > 0)]
-
-    # Prepare data for the heat map with selected crime type
-    heat_data = [[row['geometry'].centroid.y, row['geometry'].centroid.x, row[selected_crime_type]] for idx, row in filtered_crime_data.iterrows()]
-
-    # Add heat map to the map
-    HeatMap(heat_data).add_to(m)
-
-elif selected_layer == "Crime Data":
-
-    crime_data_in_district = crime_data[(crime_data['Gemeinde_name'] == selected_district) & (crime_data['Jahr'] == selected_year)]
-    
-    # Add crime data to the map
-    for _, row in crime_data_in_district.iterrows():
-        coords = row['geometry'].centroid.coords[0][::-1]  
-        popup_html = f"<b>Crime Data ({row['Jahr']})</b><br>"
-        popup_html += f"<b>Total Crimes:</b> {row['Gesamt']}<br>"
-        popup_html += f"<b>Robbery:</b> {row['Raub']}<br>"
-        popup_html += f"<b>Street Robbery:</b> {row['Straßenraub']}<br>"
-        popup_html += f"<b>Assault:</b> {row['Körperverletzung']}<br>"
-        popup_html += f"<b>Serious Assault:</b> {row['schwere Körperverletzung']}<br>"
-        popup_html += f"<b>Deprivation of Liberty:</b> {row['Freiheitsberaubung']}<br>"
-        popup_html += f"<b>Theft:</b> {row['Diebstahl']}<br>"
-        popup_html += f"<b>Other Crimes:</b> {row['Other']}<br>"
-        
-        folium.Marker(
-            location=coords,
-            popup=folium.Popup(popup_html, max_width=500),
-            icon=folium.Icon(color='green', icon='info-sign')
-        ).add_to(m)
-
-elif selected_layer == "Traffic Data":
-
-    traffic_segments_in_district = [
-        feature for feature in traffic_coordinates['features']
-        if any([district.geometry.squeeze().contains(gpd.points_from_xy([coord[0]], [coord[1]])[0]) for coord in feature['geometry']['coordinates']])
-    ]
-
-    for feature in traffic_segments_in_district:
-        coordinates = feature['geometry']['coordinates']
-        segment_id = str(feature['properties']['segment_id']) 
-
-        # Get traffic data for the segment from segments_data
-        if segment_id in segment_data:
-            segment_data_hourly = segment_data[segment_id]['averages']
-
-            # Check if selected hour data is available
-            if str(selected_hour) in segment_data_hourly:
-                data_hour = segment_data_hourly[str(selected_hour)]
-                avg_car = round(data_hour.get('avg_car', 0))
-                avg_bike = round(data_hour.get('avg_bike', 0))
-                avg_pedestrian = round(data_hour.get('avg_pedestrian', 0))
-            
-                # Add LineString to the map with traffic data pop-up
-                folium.PolyLine(
-                    locations=[(coord[1], coord[0]) for coord in coordinates],
-                    color='blue',
-                    weight=5,
-                    popup=folium.Popup(
-                        f"Segment ID: {segment_id}<br>"
-                        f"Hour: {selected_hour}<br>"
-                        f"Cars: {avg_car}<br>"
-                        f"Bikes: {avg_bike}<br>"
-                        f"Pedestrians: {avg_pedestrian}<br>",
-                        max_width=500
-                    )
-                ).add_to(m)
-
-elif selected_layer == "Police Precincts":
-
-    police_in_district = police_precincts[police_precincts.geometry.within(district.geometry.squeeze())]
-
-    for _, precinct in police_in_district.iterrows():
-        popup_html = f"<b>Police Precinct</b><br>"
-        popup_html += f"<b>Address:</b> {precinct['text']}, {precinct['locatorDesignator']}, {precinct['postCode']}<br>"
-        popup_html += f"<b>Phone:</b> {precinct['telephoneVoice']}<br>"
-        popup_html += f"<b>Website:</b> <a href='{precinct['website']}' target='_blank'>{precinct['website']}</a><br>"
-
-        # Extract coordinates from geometry
-        coordinates = precinct.geometry.coords[0]
-        lat, lon = coordinates[1], coordinates[0]
-
-        # Add marker to the map
-        folium.Marker(
-            location=[lat, lon],
-            popup=folium.Popup(popup_html, max_width=500),
-            icon=folium.Icon(color='red', icon='shield')
-        ).add_to(m)
-
-elif selected_layer == "Streetlights":
-
-    streetlights_in_district = streetlights[streetlights.geometry.within(district.geometry.squeeze())]
-
-    for _, row in streetlights_in_district.iterrows():
-        for point in row.geometry.geoms: 
-            folium.CircleMarker(
-                location=[point.y, point.x],
-                radius=0.5,
-                color='yellow',
-                fill=True,
-                fill_color='yellow'
-            ).add_to(m)
+if selected_layer == "Streetlights":
+    with timings.measure("load_streetlights"):
+        streetlight_partition = data.partitions["Streetlights"]
+        if streetlight_partition is None:
+            st.info(f"The streetlights are not available: {os.path.basename(map_layers.STREETLIGHTS_FILE)} has not been downloaded.")
+            st.stop()
+        streetlights_in_district = streetlight_partition[selected_district]
+    if streetlights_in_district["points"] is None and streetlights_in_district["cells"] is not None:
+        detail = streetlights_in_district.get("detail")
+        shown = len(detail["coordinates"]) // 2 if detail else 0
+        zoomed_in = "each one" if shown == streetlights_in_district['count'] else f"an even sample of {shown}"
+        st.sidebar.info(f"{streetlights_in_district['count']} streetlights are shown as density cells; zoom in to street level to see {zoomed_in}.")
+
+# Offer constant-size maps once the vector tile pyramid has been generated with vector_tiles.py
+use_vector_tiles = vector_tiles.tiles_available() and st.sidebar.checkbox("Load layers as vector tiles", value=True)
+
+# Serve the map from the shared cache, building it only for combinations that have not been rendered yet
+key = map_layers.map_key(selected_district, selected_layer, selected_hour, selected_year, selected_crime_type, selected_weekdays, selected_weeks)
+if use_vector_tiles:
+    key = map_layers.tiled_key(key)
+# The data service stands in for map_layers.MapData, so a cached page loads no layer data at all
+with timings.measure("map_page") as measurement:
+    map_page = get_map_cache().get_or_render(key, data, timings)
+    measurement.features = map_layers.feature_count(data, key) if timings.enabled else None
+    measurement.bytes = len(map_page)
 
 # Create space after sidebar content using Markdown
 st.sidebar.markdown("---")
 
 # Display the image at the end of the sidebar
-st.sidebar.image("./static/berlin.png", caption='Contributors: Enes, Jinlin, Kamilla', use_column_width=True)
+st.sidebar.image(image_data_url("./static/berlin.png"), caption='Contributors: Enes, Jinlin, Kamilla', use_column_width=True)
 
 # Display the map with Streamlit
-st_folium(m, width=1400, height=1000)
\ No newline at end of file
+with timings.measure("components_html") as measurement:
+    components.html(map_page, width=1400, height=1000)
+    measurement.bytes = len(map_page)
+
+# Optional debug panel with the timings of this rerun, which are also logged and exported
+if timings.enabled:
+    with st.sidebar.expander("Debug: timings of this rerun"):
+        st.dataframe(timings.rows())
+timings.finish(district=selected_district, layer=selected_layer, key=key)
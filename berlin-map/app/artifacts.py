@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import shutil
+import argparse
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from pathlib import Path
+
+import geopandas as gpd
+
+import get_crime
+import layer_partitions
+import map_layers
+import traffic_store
+
+# Read-only directory every app worker serves from; a symlink to the latest build written by this script
+ARTIFACTS_DIR = Path(os.environ.get("BERLIN_MAP_ARTIFACTS", Path(__file__).parent / 'artifacts'))
+
+MANIFEST_FILE = 'manifest.json'
+GEOJSON_DIR = 'geojson'
+TRAFFIC_STORE_DIR = 'traffic_store'
+CRIME_CACHE_DIR = 'crime_cache'
+PARTITIONS_DIR = 'partitions'
+RENDERED_MAPS_DIR = 'rendered_maps'
+
+# Builds are kept next to the symlink in <name>-versions/; the one before the current build is kept too,
+# because workers started on it keep reading it until they are restarted
+VERSIONS_SUFFIX = '-versions'
+KEEP_VERSIONS = 2
+
+
+def available(artifacts_dir=ARTIFACTS_DIR):
+    return (Path(artifacts_dir) / MANIFEST_FILE).exists()
+
+
+def current(artifacts_dir=ARTIFACTS_DIR):
+    """Returns the build the symlink points to right now, or None when nothing has been built.
+
+    Workers hold on to the resolved directory, so a newer build swapped in later cannot mix with the one
+    they started with.
+    """
+    return Path(artifacts_dir).resolve() if available(artifacts_dir) else None
+
+
+def load_manifest(artifacts_dir=ARTIFACTS_DIR):
+    with open(Path(artifacts_dir) / MANIFEST_FILE, 'r') as file:
+        return json.load(file)
+
+
+def layer_dir(layer, artifacts_dir=ARTIFACTS_DIR):
+    return Path(artifacts_dir) / PARTITIONS_DIR / layer.lower().replace(' ', '_')
+
+
+def write_partition(layer, partition, directory):
+    """Writes one file per district: GeoParquet for GeoDataFrames, JSON for GeoJSON features and LOD entries."""
+    directory.mkdir(parents=True)
+    files = {}
+    for index, (name, value) in enumerate(partition.items()):
+        if isinstance(value, gpd.GeoDataFrame):
+            files[name] = f"{index}.parquet"
+            value.to_parquet(directory / files[name])
+        else:
+            files[name] = f"{index}.json"
+            with open(directory / files[name], 'w') as file:
+                json.dump(value, file, separators=(',', ':'))
+    return files
+
+
+class PartitionFiles(Mapping):
+    """Read-only {Gemeinde_name: partition} view over the files of one layer written by write_partition.
+
+    A district is read from its file on every lookup and not kept, so the only copy that lasts is the one in
+    the OS page cache, which all workers on the machine share. Lookups are rare because pages are cached.
+    """
+
+    def __init__(self, directory, files):
+        self.directory = Path(directory)
+        self.files = files
+
+    def __getitem__(self, name):
+        file_path = self.directory / self.files[name]
+        if file_path.suffix == '.parquet':
+            return gpd.read_parquet(file_path)
+        with open(file_path, 'r') as file:
+            return json.load(file)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+
+def loaders(artifacts_dir=ARTIFACTS_DIR):
+    """Returns data_service loaders that read the precomputed datasets instead of deriving them from the sources."""
+    artifacts_dir = Path(artifacts_dir)
+    geojson_dir = artifacts_dir / GEOJSON_DIR
+
+    result = {
+        "districts": lambda: gpd.read_file(geojson_dir / Path(map_layers.DISTRICTS_FILE).name),
+        "police_precincts": lambda: gpd.read_file(geojson_dir / Path(map_layers.POLICE_PRECINCTS_FILE).name),
+        # Memory-mapped, so all workers on the machine share the same pages of the files
+        "segment_data": lambda: traffic_store.TrafficStore(artifacts_dir / TRAFFIC_STORE_DIR),
+        "crime_data": lambda: get_crime.load_and_process_crime_data(cache_dir=artifacts_dir / CRIME_CACHE_DIR),
+    }
+    for layer, files in load_manifest(artifacts_dir)["partitions"].items():
+        result[layer] = lambda layer=layer, files=files: PartitionFiles(layer_dir(layer, artifacts_dir), files)
+    return result
+
+
+def make_read_only(directory):
+    for root, directories, files in os.walk(directory):
+        for name in files:
+            os.chmod(os.path.join(root, name), 0o444)
+        for name in directories:
+            os.chmod(os.path.join(root, name), 0o555)
+    os.chmod(directory, 0o555)
+
+
+def make_writable(directory):
+    os.chmod(directory, 0o755)
+    for root, directories, files in os.walk(directory):
+        for name in directories:
+            os.chmod(os.path.join(root, name), 0o755)
+        for name in files:
+            os.chmod(os.path.join(root, name), 0o644)
+
+
+def swap_in(version_dir, output_dir):
+    """Points the output_dir symlink at version_dir in one rename, so a worker sees either build but never neither."""
+    if output_dir.exists() and not output_dir.is_symlink():
+        # Left by a build from before the artifacts were versioned; this one switch cannot be atomic
+        make_writable(output_dir)
+        shutil.rmtree(output_dir)
+    link = output_dir.with_name(output_dir.name + '.link')
+    if link.is_symlink():
+        link.unlink()
+    link.symlink_to(os.path.relpath(version_dir, output_dir.parent))
+    os.replace(link, output_dir)
+
+    for outdated in sorted(version_dir.parent.iterdir())[:-KEEP_VERSIONS]:
+        make_writable(outdated)
+        shutil.rmtree(outdated)
+
+
+def build_artifacts(output_dir=ARTIFACTS_DIR):
+    """Derives everything the app serves into a new read-only build and points output_dir at it.
+
+    That is the GeoJSON assets, the traffic store, the crime cache, every layer's district partition and a
+    pre-rendered page for every map. Layers whose source file is missing are left out and derived by the
+    workers on demand as before.
+    """
+    # Imported here because data_service reads the artifacts through this module
+    import data_service
+    import map_cache
+
+    output_dir = Path(output_dir)
+    created = datetime.now(timezone.utc)
+    version_dir = output_dir.with_name(output_dir.name + VERSIONS_SUFFIX) / created.strftime('%Y%m%dT%H%M%S%f')
+    start = time.perf_counter()
+
+    (version_dir / GEOJSON_DIR).mkdir(parents=True)
+    for file_path in [map_layers.DISTRICTS_FILE, map_layers.POLICE_PRECINCTS_FILE]:
+        shutil.copyfile(file_path, version_dir / GEOJSON_DIR / Path(file_path).name)
+    shutil.copytree(map_layers.TRAFFIC_STORE_DIR, version_dir / TRAFFIC_STORE_DIR)
+    get_crime.build_crime_cache(cache_dir=version_dir / CRIME_CACHE_DIR)
+
+    service = data_service.DataService()
+    partitions = {}
+    sources = {"Traffic Data": map_layers.TRAFFIC_FILE, "Streetlights": map_layers.STREETLIGHTS_FILE, "Police Precincts": map_layers.POLICE_PRECINCTS_FILE}
+    for layer in layer_partitions.PARTITIONERS:
+        if not Path(sources[layer]).exists():
+            print(f"Skipping the {layer} partition: {sources[layer]} is missing")
+            continue
+        partitions[layer] = write_partition(layer, service.partitions[layer], layer_dir(layer, version_dir))
+
+    (version_dir / RENDERED_MAPS_DIR).mkdir()
+    maps = 0
+    for key in map_layers.all_map_keys(service):
+        if key[1] in layer_partitions.PARTITIONERS and key[1] not in partitions:
+            continue
+        page = map_layers.render_map(service, key)
+        (version_dir / RENDERED_MAPS_DIR / map_cache.key_filename(key)).write_text(page, encoding='utf-8')
+        maps += 1
+
+    manifest = {
+        "created": created.isoformat(),
+        "data_version": map_cache.data_version(),
+        "partitions": partitions,
+        "maps": maps,
+    }
+    with open(version_dir / MANIFEST_FILE, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    make_read_only(version_dir)
+    swap_in(version_dir, output_dir)
+    print(f"Built {len(partitions)} partitions and {maps} maps into {version_dir} in {time.perf_counter() - start:.1f} s")
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the read-only directory of derived data that app workers serve from.")
+    parser.add_argument("--output-dir", default=ARTIFACTS_DIR, help="symlink the latest build is reachable under")
+    args = parser.parse_args()
+    build_artifacts(args.output_dir)
@@ -0,0 +1,276 @@
+import gc
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+import get_crime
+import layer_partitions
+import map_layers
+import segment_traffic_data
+import traffic_store
+from benchmarks import DATA_DIR, load_streetlights
+
+RESULTS_DIR = DATA_DIR / 'benchmark_results'
+
+# Dataset sizes the layer benchmarks run at, as multiples of the checked-in data
+SCALES = (1, 10, 100)
+
+# Streetlights at scale 1, sampled from pruned_streetlight.geojson or synthetic when it is missing; 100x the
+# whole file or the 200k used elsewhere would not fit in memory on a small machine
+BASE_STREETLIGHTS = 20000
+
+# Cases that got slower than this factor since the previous run are reported as regressions
+REGRESSION_THRESHOLD = 1.2
+
+# Runs per case and pass; every run is kept, and a case is reported by its median and its range
+REPEAT = 5
+
+# Passes over all select and render cases, so a burst of load on the machine lands in a few runs of many
+# cases rather than in every run of a few
+ROUNDS = 3
+
+# Cases faster than this in the previous run, or whose median moved by less than MIN_DELTA, are within the
+# timer's and the machine's noise; on a shared single core, two runs of the same code differ by up to 50%
+# on 30 ms renders
+MIN_SECONDS = 0.005
+MIN_DELTA = 0.002
+
+# Cases timed fewer times than this, such as building the partitions, are too few runs to tell a burst of
+# load from a regression; their changes are printed but do not fail the run
+MIN_RUNS = 5
+
+# Distance in degrees (about 2 km) that scaled copies of segments and streetlights are shifted by at most
+JITTER = 0.02
+
+
+def scale_traffic_geojson(traffic_geojson, factor, seed=0):
+    """Returns factor copies of every segment, shifted randomly, with ids that do not collide with the originals."""
+    rng = np.random.default_rng(seed)
+    features = []
+    for copy in range(factor):
+        offset = rng.uniform(-JITTER, JITTER, 2) if copy else np.zeros(2)
+        for feature in traffic_geojson['features']:
+            coordinates = (np.array(feature['geometry']['coordinates']) + offset).tolist()
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": feature['geometry']['type'], "coordinates": coordinates},
+                "properties": {**feature['properties'], "segment_id": int(feature['properties']['segment_id']) + copy * 10 ** 10}
+            })
+    return {**traffic_geojson, "features": features}
+
+
+def scale_streetlights(streetlights, factor, seed=0):
+    """Returns the streetlights plus factor - 1 randomly shifted copies, as single points."""
+    rng = np.random.default_rng(seed)
+    coords = shapely.get_coordinates(streetlights.geometry.values)
+    offsets = np.vstack([np.zeros(2), rng.uniform(-JITTER, JITTER, (factor - 1, 2))])
+    scaled = (coords[np.newaxis] + offsets[:, np.newaxis]).reshape(-1, 2)
+    return gpd.GeoDataFrame(geometry=gpd.points_from_xy(scaled[:, 0], scaled[:, 1]), crs=streetlights.crs)
+
+
+def sample_streetlights(streetlights, count, seed=0):
+    """Returns at most count of the streetlights' points, drawn at random, as single points."""
+    coords = shapely.get_coordinates(streetlights.geometry.values)
+    if len(coords) > count:
+        coords = coords[np.sort(np.random.default_rng(seed).choice(len(coords), count, replace=False))]
+    return gpd.GeoDataFrame(geometry=gpd.points_from_xy(coords[:, 0], coords[:, 1]), crs=streetlights.crs)
+
+
+def scale_traffic_store(store, factor, store_dir):
+    """Writes a traffic store holding the averages of every segment once per copy made by scale_traffic_geojson."""
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    segment_ids = np.concatenate([store.segment_ids + copy * 10 ** 10 for copy in range(factor)])
+    np.save(store_dir / traffic_store.SEGMENT_IDS_FILE, segment_ids)
+    np.save(store_dir / traffic_store.AVERAGES_FILE, np.tile(np.asarray(store.averages), (factor, 1, 1)))
+    return traffic_store.TrafficStore(store_dir)
+
+
+def time_runs(func, *args, repeat=REPEAT):
+    """Returns the wall times in seconds of `repeat` calls, together with the last result."""
+    seconds = []
+    result = None
+    # Collect the garbage of earlier cases now rather than in the middle of this one
+    gc.collect()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds.append(time.perf_counter() - start)
+    return seconds, result
+
+
+def benchmark_loaders(results):
+    """Times every loader app.py calls at startup, plus re-aggregating the segment reports, in ROUNDS passes."""
+    cases = {
+        "load/districts": lambda: gpd.read_file(map_layers.DISTRICTS_FILE),
+        "load/police_precincts": lambda: map_layers.load_police_precincts(),
+        "load/traffic_geojson": lambda: json.loads(Path(map_layers.TRAFFIC_FILE).read_text()),
+        "load/traffic_store": lambda: traffic_store.TrafficStore(map_layers.TRAFFIC_STORE_DIR),
+        "load/crime_data": get_crime.load_and_process_crime_data,
+        "load/segment_aggregation": lambda: segment_traffic_data.fetch_and_process_all_segments(
+            DATA_DIR / 'segment_traffic_data', workers=1, full=True
+        ),
+    }
+    if Path(map_layers.STREETLIGHTS_FILE).exists():
+        cases["load/streetlights"] = lambda: gpd.read_file(map_layers.STREETLIGHTS_FILE)
+    for _ in range(ROUNDS):
+        for name, func in cases.items():
+            # Re-aggregating takes seconds, one run per pass is enough to rise above the noise
+            seconds, _ = time_runs(func, repeat=1 if name == "load/segment_aggregation" else REPEAT)
+            results.setdefault(name, []).extend(seconds)
+
+
+def select_features(data, layer, district, key):
+    """The per-interaction lookup app.py does for a layer before drawing it."""
+    if layer == "Crime Data":
+        return data.crime_data[(data.crime_data['Gemeinde_name'] == district) & (data.crime_data['Jahr'] == key[-1])]
+    if layer == "Crime Heat Map":
+        return data.crime_heat_data[key[-2:]]
+    return data.partitions[layer][district]
+
+
+def benchmark_layers(results, scale, districts, police_precincts, traffic_geojson, streetlights, store, crime_data, crime_heat_data):
+    """Times building the partitions, then selecting and rendering every layer for every district, at one scale.
+
+    The select and render cases are timed in ROUNDS passes spread over the run.
+    """
+    with tempfile.TemporaryDirectory() as store_dir:
+        scaled_geojson = scale_traffic_geojson(traffic_geojson, scale)
+        scaled_store = scale_traffic_store(store, scale, store_dir)
+        scaled_streetlights = scale_streetlights(streetlights, scale) if scale > 1 else streetlights
+
+        suffix = f"@{scale}x"
+        results["build/partitions" + suffix], partitions = time_runs(
+            layer_partitions.build_layer_partitions, districts, police_precincts, scaled_geojson, scaled_streetlights, repeat=1
+        )
+        data = map_layers.MapData(districts, partitions, scaled_store, crime_data, crime_heat_data)
+
+        year = int(crime_data["Jahr"].max())
+        keys = {}
+        layers = ["Traffic Data", "Streetlights", "Police Precincts"]
+        if scale == 1:
+            # The crime layers come from the workbook, which is not scaled
+            keys["Crime Heat Map"] = {None: map_layers.map_key(None, "Crime Heat Map", selected_year=year, selected_crime_type="Gesamt")}
+            layers.insert(0, "Crime Data")
+        for layer in layers:
+            keys[layer] = {
+                district: map_layers.map_key(district, layer, selected_hour=8, selected_year=year)
+                for district in districts['Gemeinde_name']
+            }
+        for _ in range(ROUNDS):
+            for layer, layer_keys in keys.items():
+                for district, key in layer_keys.items():
+                    case = f"{layer}/{district or 'all districts'}{suffix}"
+                    for name, func, args in [("select/", select_features, (data, layer, district, key)), ("render/", map_layers.render_map, (data, key))]:
+                        seconds, _ = time_runs(func, *args)
+                        results.setdefault(name + case, []).extend(seconds)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def summarize(results):
+    """Turns {case: [seconds of every run]} into the median ("seconds") and [min, max] ("ranges") of each case."""
+    return {
+        "seconds": {name: statistics.median(samples) for name, samples in results.items()},
+        "ranges": {name: [min(samples), max(samples)] for name, samples in results.items()},
+        "runs": {name: len(samples) for name, samples in results.items()},
+    }
+
+
+def save_results(results, results_dir=RESULTS_DIR):
+    """Writes one JSON file per run, named so that the files sort by time, and returns its path and contents."""
+    results_dir = Path(results_dir)
+    results_dir.mkdir(parents=True, exist_ok=True)
+    created = datetime.now(timezone.utc)
+    revision = git_revision()
+    run = {"revision": revision, "created": created.isoformat(), "machine": platform.node(), **summarize(results)}
+    file_path = results_dir / f"{created.strftime('%Y%m%dT%H%M%S')}-{revision}.json"
+    with open(file_path, 'w') as file:
+        json.dump(run, file, indent=1, sort_keys=True)
+    return file_path, run
+
+
+def load_previous_results(results_dir=RESULTS_DIR, before=None):
+    """Returns the most recent run saved in results_dir other than `before`, or None."""
+    runs = sorted(path for path in Path(results_dir).glob('*.json') if path != before)
+    if not runs:
+        return None
+    with open(runs[-1], 'r') as file:
+        return json.load(file)
+
+
+def compare(run, previous, threshold=REGRESSION_THRESHOLD, min_seconds=MIN_SECONDS, min_delta=MIN_DELTA, min_runs=MIN_RUNS):
+    """Prints the cases whose time changed by more than threshold and returns the names of the slower ones.
+
+    Only cases whose median took at least min_seconds before and moved by at least min_delta are compared,
+    and a change only counts when the two runs' ranges do not overlap, i.e. when every run of the case got
+    slower (or faster) than every run before. Slower cases timed fewer than min_runs times are printed as
+    "slower?" and not returned.
+    """
+    regressions = []
+    for name, seconds in sorted(run["seconds"].items()):
+        before = previous["seconds"].get(name)
+        if not before or before < min_seconds or abs(seconds - before) < min_delta:
+            continue
+        ratio = seconds / before
+        # Runs saved before ranges were recorded are compared by their medians alone
+        low, high = run["ranges"][name]
+        before_low, before_high = previous.get("ranges", {}).get(name, [before, before])
+        if ratio > threshold and low > before_high:
+            measured = run["runs"][name] >= min_runs
+            if measured:
+                regressions.append(name)
+            print(f"{'SLOWER ' if measured else 'slower?'} {name:<60}{before * 1000:>10.1f} -> {seconds * 1000:>10.1f} ms ({ratio:.2f}x)")
+        elif ratio < 1 / threshold and high < before_low:
+            print(f"faster  {name:<60}{before * 1000:>10.1f} -> {seconds * 1000:>10.1f} ms ({ratio:.2f}x)")
+    return regressions
+
+
+def run_suite(scales=SCALES, results_dir=RESULTS_DIR):
+    """Runs every benchmark, saves the timings and compares them with the previous run."""
+    start = time.perf_counter()
+    results = {}
+    benchmark_loaders(results)
+
+    districts = gpd.read_file(map_layers.DISTRICTS_FILE)
+    police_precincts = map_layers.load_police_precincts()
+    traffic_geojson = json.loads(Path(map_layers.TRAFFIC_FILE).read_text())
+    streetlights = sample_streetlights(load_streetlights(districts, count=BASE_STREETLIGHTS), BASE_STREETLIGHTS)
+    store = traffic_store.TrafficStore(map_layers.TRAFFIC_STORE_DIR)
+    crime_data = get_crime.load_and_process_crime_data()
+    crime_heat_data = get_crime.heat_data_by_year_and_type(crime_data)
+    for scale in scales:
+        benchmark_layers(results, scale, districts, police_precincts, traffic_geojson, streetlights, store, crime_data, crime_heat_data)
+
+    file_path, run = save_results(results, results_dir)
+    print(f"{len(results)} cases in {time.perf_counter() - start:.0f} s, saved to {file_path}")
+    previous = load_previous_results(results_dir, before=file_path)
+    if previous is None:
+        return []
+    print(f"Compared with {previous['revision']} ({previous['created']}):")
+    return compare(run, previous)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the loaders and every layer for every district, and compare with the last run.")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES, help="multiples of the checked-in data to run the layer benchmarks at")
+    parser.add_argument("--results-dir", default=RESULTS_DIR, help="directory the timings of every run are kept in")
+    args = parser.parse_args()
+
+    regressions = run_suite(args.scales, args.results_dir)
+    raise SystemExit(1 if regressions else 0)
@@ -0,0 +1,312 @@
+import json
+import math
+import time
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+import api_script
+import district_index
+import layer_partitions
+import reprojection
+import segment_traffic_data
+import streaming_json
+import telraam_stub
+import traffic_aggregation
+
+DATA_DIR = Path(__file__).parent
+
+
+def time_call(func, *args, repeat=3):
+    """Returns the best wall time in seconds over `repeat` calls, together with the last result."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def naive_segments_in_district(traffic_geojson, district):
+    """The original per-vertex filter from app.py, kept as the baseline."""
+    return [
+        feature for feature in traffic_geojson['features']
+        if any([district.geometry.squeeze().contains(gpd.points_from_xy([coord[0]], [coord[1]])[0]) for coord in feature['geometry']['coordinates']])
+    ]
+
+
+def benchmark_traffic_filter():
+    """Compares the per-rerun segment-in-district filter before and after the spatial index."""
+    districts = gpd.read_file(DATA_DIR / 'bezirksgrenzen.geojson')
+    with open(DATA_DIR / 'converted_telraam_segments.geojson', 'r') as file:
+        traffic_geojson = json.load(file)
+
+    index_time, segments_in_district = time_call(district_index.segments_by_district, traffic_geojson, districts, repeat=1)
+    print(f"Building the segment index: {index_time * 1000:.1f} ms (once per process)")
+    print(f"{'District':<28}{'Segments':>10}{'Before (ms)':>14}{'After (ms)':>14}{'Speedup':>10}")
+
+    total_before = total_after = 0.0
+    for name in districts['Gemeinde_name']:
+        district = districts[districts['Gemeinde_name'] == name]
+        before, expected = time_call(naive_segments_in_district, traffic_geojson, district)
+        after, actual = time_call(segments_in_district.get, name, repeat=1000)
+        assert [f['properties']['segment_id'] for f in expected] == [f['properties']['segment_id'] for f in actual], name
+        total_before += before
+        total_after += after
+        print(f"{name:<28}{len(actual):>10}{before * 1000:>14.2f}{after * 1000:>14.4f}{before / after:>10.0f}x")
+
+    print(f"{'All districts':<28}{'':>10}{total_before * 1000:>14.2f}{total_after * 1000:>14.4f}{total_before / total_after:>10.0f}x")
+
+
+def reference_process_traffic_data(data):
+    """The original per-report aggregation from segment_traffic_data.py, kept as the baseline."""
+    hourly_traffic = {hour: {"car": [], "bike": [], "pedestrian": []} for hour in range(24)}
+
+    for report in data.get('report', []):
+        dt = datetime.fromisoformat(report['date'].replace("Z", "+00:00"))
+        hour = dt.hour
+        hourly_traffic[hour]["car"].append(report['car'])
+        hourly_traffic[hour]["bike"].append(report['bike'])
+        hourly_traffic[hour]["pedestrian"].append(report['pedestrian'])
+
+    averages = {hour: {
+        "avg_car": sum(values["car"]) / len(values["car"]) if values["car"] else 0,
+        "avg_bike": sum(values["bike"]) / len(values["bike"]) if values["bike"] else 0,
+        "avg_pedestrian": sum(values["pedestrian"]) / len(values["pedestrian"]) if values["pedestrian"] else 0
+    } for hour, values in hourly_traffic.items()}
+
+    return averages
+
+
+def assert_same_averages(expected, actual, label):
+    """Checks that two {hour: {"avg_*": value}} structures agree up to floating point rounding."""
+    assert expected.keys() == actual.keys(), label
+    for hour, values in expected.items():
+        assert values.keys() == actual[hour].keys(), label
+        for key, value in values.items():
+            assert math.isclose(value, actual[hour][key], rel_tol=1e-9, abs_tol=1e-9), (label, hour, key)
+
+
+def benchmark_traffic_aggregation(data_folder=DATA_DIR / 'segment_traffic_data'):
+    """Times the per-report aggregation against the vectorized one and checks that both agree."""
+    reports = []
+    for file_path in sorted(Path(data_folder).glob('*.json')):
+        with open(file_path, 'r') as file:
+            reports.append((file_path.stem, json.load(file)))
+
+    total_before = total_after = 0.0
+    for segment_id, data in reports:
+        before, expected = time_call(reference_process_traffic_data, data)
+        after, actual = time_call(traffic_aggregation.process_traffic_data, data)
+        assert_same_averages(expected, actual, segment_id)
+        total_before += before
+        total_after += after
+
+    rows = sum(len(data.get('report', [])) for _, data in reports)
+    print(f"Aggregated {rows} reports from {len(reports)} segments, results match")
+    print(f"Before: {total_before * 1000:.1f} ms, after: {total_after * 1000:.1f} ms, speedup {total_before / total_after:.1f}x")
+
+
+def benchmark_window_updates(segment_count=5, days=30):
+    """Steps the rolling window of api_script.update_segment over the stub API and checks it against re-aggregating.
+
+    After every step the stored reports must be exactly the source reports inside the window and the running
+    averages those of the per-report baseline over them. The steps cover a filling window, overlapping
+    windows, a jump past the whole window and a window after the last report.
+    """
+    data_folder = DATA_DIR / 'segment_traffic_data'
+    segment_ids = [file_path.stem for file_path in sorted(data_folder.glob('*.json'))[:segment_count]]
+    sources = {}
+    for segment_id in segment_ids:
+        with open(data_folder / f"{segment_id}.json", 'r') as file:
+            sources[segment_id] = json.load(file)['report']
+
+    now = datetime(2024, 4, 10, tzinfo=timezone.utc)
+    steps = [now]
+    for step_days in [1, 1, 3, 7, 15, 29, 45, 2, 10, 60]:
+        now += timedelta(days=step_days)
+        steps.append(now)
+
+    server = telraam_stub.create_server(data_folder=data_folder)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    session = api_script.create_session(1)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            entries = dict.fromkeys(segment_ids)
+            for now in steps:
+                window_start = now - timedelta(days=days)
+                for segment_id in segment_ids:
+                    entries[segment_id] = api_script.update_segment(segment_id, entries[segment_id], now, days, temp_dir, session, base_url)
+                    label = (segment_id, now.isoformat())
+
+                    window = [report for report in sources[segment_id] if window_start <= api_script.parse_time(report['date']) < now]
+                    stored = api_script.load_segment_data(segment_id, temp_dir)['report']
+                    assert [report['date'] for report in stored] == [report['date'] for report in window], label
+                    assert entries[segment_id]["report_count"] == len(window), label
+
+                    expected = reference_process_traffic_data({"report": window})
+                    actual = traffic_aggregation.HourlyAccumulator.from_state(entries[segment_id]).averages()
+                    assert_same_averages(expected, actual, label)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print(f"Stepped a {days}-day window {len(steps)} times over {len(segment_ids)} segments, incremental averages match re-aggregation")
+
+
+def load_streetlights(districts, count=200000, seed=0):
+    """Loads pruned_streetlight.geojson, or scatters `count` synthetic streetlights over Berlin if it is missing."""
+    streetlights_file = DATA_DIR / 'pruned_streetlight.geojson'
+    if streetlights_file.exists():
+        return gpd.read_file(streetlights_file)
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = districts.total_bounds
+    coords = np.column_stack([rng.uniform(minx, maxx, count), rng.uniform(miny, maxy, count)])
+    # Group the points four at a time, like the MultiPoint rows of the real file
+    return gpd.GeoDataFrame(geometry=shapely.multipoints(coords[:count - count % 4].reshape(-1, 4, 2)), crs=districts.crs)
+
+
+def benchmark_district_sweep():
+    """Times selecting every layer's features for every district, per interaction before and from partitions after."""
+    districts = gpd.read_file(DATA_DIR / 'bezirksgrenzen.geojson')
+    police_precincts = gpd.read_file(DATA_DIR / 'converted_police_precincts.geojson')
+    with open(DATA_DIR / 'converted_telraam_segments.geojson', 'r') as file:
+        traffic_geojson = json.load(file)
+    streetlights = load_streetlights(districts)
+
+    def sweep_before():
+        for name in districts['Gemeinde_name']:
+            district = districts[districts['Gemeinde_name'] == name]
+            police_precincts[police_precincts.geometry.within(district.geometry.squeeze())]
+            naive_segments_in_district(traffic_geojson, district)
+            streetlights[streetlights.geometry.within(district.geometry.squeeze())]
+
+    before, _ = time_call(sweep_before, repeat=1)
+    build, partitions = time_call(layer_partitions.build_layer_partitions, districts, police_precincts, traffic_geojson, streetlights, repeat=1)
+
+    def sweep_after():
+        for name in districts['Gemeinde_name']:
+            for layer in partitions.values():
+                layer[name]
+
+    after, _ = time_call(sweep_after, repeat=100)
+    print(f"Sweep over {len(districts)} districts x 3 layers ({len(streetlights)} streetlight rows)")
+    print(f"Before: {before * 1000:.1f} ms per sweep")
+    print(f"After: {build * 1000:.1f} ms once to build the partitions, then {after * 1000:.4f} ms per sweep")
+
+
+def benchmark_reprojection():
+    """Times converting the streetlights from EPSG:25833 to WGS84 point by point and in one batch."""
+    districts = gpd.read_file(DATA_DIR / 'bezirksgrenzen.geojson')
+    geometries = reprojection.reproject_geometries(load_streetlights(districts).geometry.values, "EPSG:4326", "EPSG:25833")
+    transformer = reprojection.get_transformer("EPSG:25833", "EPSG:4326")
+
+    def per_point():
+        # One transform call per coordinate pair, as police_precincts.py used to do per Point feature
+        return [transformer.transform(point.x, point.y) for multipoint in geometries for point in multipoint.geoms]
+
+    before, expected = time_call(per_point, repeat=1)
+    after, actual = time_call(reprojection.reproject_geometries, geometries, "EPSG:25833", "EPSG:4326")
+    assert np.allclose(np.array(expected), shapely.get_coordinates(actual))
+    points = len(shapely.get_coordinates(geometries))
+    print(f"Reprojected {points} streetlight points, results match")
+    print(f"Before: {before * 1000:.1f} ms, after: {after * 1000:.1f} ms, speedup {before / after:.0f}x")
+
+
+def peak_memory(func, *args):
+    """Returns the peak of memory allocated through Python while func runs, in bytes, together with its result."""
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+
+def write_report_file(file_path, template_reports, hours):
+    """Writes a Telraam report file covering `hours` consecutive hours, cycling through the template rows."""
+    start = np.datetime64('2024-01-01T00', 'h')
+    with open(file_path, 'w') as file:
+        file.write('{"report": [')
+        for hour in range(hours):
+            report = dict(template_reports[hour % len(template_reports)])
+            report['date'] = f"{start + hour}:00:00.000Z"
+            file.write((',' if hour else '') + json.dumps(report))
+        file.write(']}')
+
+
+def write_segments_file(file_path, traffic_geojson, copies, seed=0):
+    """Writes a GeoJSON file with `copies` copies of the segments scattered over Germany, like a nationwide export."""
+    rng = np.random.default_rng(seed)
+    with open(file_path, 'w') as file:
+        file.write('{"type": "FeatureCollection", "features": [')
+        for copy in range(copies):
+            # The first copy stays in Berlin, the others land anywhere between 6-15 E and 47-55 N
+            offset = np.zeros(2) if copy == 0 else rng.uniform([-7.4, -5.5], [1.6, 2.5])
+            for position, feature in enumerate(traffic_geojson['features']):
+                geometry = {"type": feature['geometry']['type'], "coordinates": (np.array(feature['geometry']['coordinates']) + offset).tolist()}
+                separator = ',' if copy or position else ''
+                file.write(separator + json.dumps({"type": "Feature", "geometry": geometry, "properties": feature['properties']}))
+        file.write(']}')
+
+
+def load_and_process_segment_file(file_path):
+    """The aggregation before streaming: parse the whole file, then aggregate."""
+    with open(file_path, 'r') as file:
+        data = json.load(file)
+    return traffic_aggregation.process_traffic_data(data), traffic_aggregation.traffic_cube(data['report'])
+
+
+def load_and_index_segments(file_path, districts):
+    """The segment index before streaming: parse the whole file, then join it against the districts."""
+    with open(file_path, 'r') as file:
+        return district_index.segments_by_district(json.load(file), districts)
+
+
+def benchmark_streaming_memory():
+    """Compares peak memory of parsing whole files and of streaming them, for growing report and segment files."""
+    districts = gpd.read_file(DATA_DIR / 'bezirksgrenzen.geojson')
+    with open(DATA_DIR / 'converted_telraam_segments.geojson', 'r') as file:
+        traffic_geojson = json.load(file)
+    template_file = sorted((DATA_DIR / 'segment_traffic_data').glob('*.json'))[0]
+    with open(template_file, 'r') as file:
+        template_reports = json.load(file)['report']
+
+    print(f"{'Input':<36}{'MB':>8}{'Before (MB)':>14}{'After (MB)':>13}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for years in (1, 4):
+            file_path = Path(temp_dir) / f"reports_{years}y.json"
+            write_report_file(file_path, template_reports, years * 365 * 24)
+            before, expected = peak_memory(load_and_process_segment_file, file_path)
+            after, (_, averages, cube) = peak_memory(segment_traffic_data.process_segment_file, file_path)
+            # Summing in chunks changes the rounding of the float sums, not the values
+            assert averages.keys() == expected[0].keys() and all(np.allclose(list(averages[hour].values()), list(expected[0][hour].values())) for hour in averages)
+            assert cube["weeks"] == expected[1]["weeks"] and np.allclose(cube["sums"], expected[1]["sums"]) and cube["counts"] == expected[1]["counts"]
+            print(f"{f'Reports, {years} year(s)':<36}{file_path.stat().st_size / 1e6:>8.1f}{before / 1e6:>14.1f}{after / 1e6:>13.1f}")
+
+        for copies in (10, 100):
+            file_path = Path(temp_dir) / f"segments_{copies}x.geojson"
+            write_segments_file(file_path, traffic_geojson, copies)
+            before, expected = peak_memory(load_and_index_segments, file_path, districts)
+            after, actual = peak_memory(district_index.stream_segments_by_district, streaming_json.iter_features(file_path), districts)
+            assert [[f['properties']['segment_id'] for f in expected[name]] for name in expected] == [[f['properties']['segment_id'] for f in actual[name]] for name in actual]
+            print(f"{f'Segments, {copies}x':<36}{file_path.stat().st_size / 1e6:>8.1f}{before / 1e6:>14.1f}{after / 1e6:>13.1f}")
+    print("Results match" + ("" if streaming_json.ijson else " (ijson is not installed, so the streaming side parses whole files too)"))
+
+
+if __name__ == "__main__":
+    benchmark_traffic_filter()
+    benchmark_traffic_aggregation()
+    benchmark_window_updates()
+    benchmark_district_sweep()
+    benchmark_reprojection()
+    benchmark_streaming_memory()
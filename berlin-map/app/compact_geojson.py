@@ -0,0 +1,172 @@
+import json
+import time
+import argparse
+from pathlib import Path
+
+import folium
+import geopandas as gpd
+import numpy as np
+import shapely
+
+import segment_traffic_data
+
+DATA_DIR = Path(__file__).parent
+COMPACT_DIR = DATA_DIR / 'compact'
+
+# Records which source file and settings every compact file was written from
+MANIFEST_FILE = 'manifest.json'
+
+# Five decimal places are about 1.1 m of latitude and 0.7 m of longitude in Berlin
+PRECISION = 5
+
+# Projected CRS the simplification tolerances are measured in
+METRIC_CRS = "EPSG:25833"
+
+# Simplification tolerance in metres for every asset the app loads; None only quantizes (point layers)
+ASSETS = {
+    'bezirksgrenzen.geojson': 5.0,
+    'converted_telraam_segments.geojson': 1.0,
+    'bzm_telraam_segments.geojson': 1.0,
+    'converted_police_precincts.geojson': None,
+    'pruned_streetlight.geojson': None,
+}
+
+
+def source_entry(file_path):
+    stat = Path(file_path).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": segment_traffic_data.file_hash(file_path)}
+
+
+def is_unchanged(entry, file_path):
+    stat = Path(file_path).stat()
+    if stat.st_size != entry["size"]:
+        return False
+    return stat.st_mtime_ns == entry["mtime_ns"] or segment_traffic_data.file_hash(file_path) == entry["sha256"]
+
+
+def load_manifest(compact_dir=COMPACT_DIR):
+    manifest_path = Path(compact_dir) / MANIFEST_FILE
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+
+def compact_path(file_path, compact_dir=COMPACT_DIR):
+    """Returns the compact copy of a GeoJSON asset written by this script, or file_path if there is none.
+
+    The copy is only used while the source still has the hash it was written from; an edited source is
+    served as it is until this script is run again. The source is only hashed when its size or mtime differ
+    from the ones recorded, e.g. after a fresh checkout.
+    """
+    file_path = Path(file_path)
+    compact_file = Path(compact_dir) / file_path.name
+    if not compact_file.exists():
+        return file_path
+    entry = load_manifest(compact_dir).get(file_path.name)
+    if entry is None or not file_path.exists() or not is_unchanged(entry, file_path):
+        print(f"{compact_file} is out of date with {file_path}, using the source; run compact_geojson.py to rebuild it")
+        return file_path
+    return compact_file
+
+
+def simplify_geometries(geometries, tolerance):
+    """Simplifies WGS84 geometries with a tolerance in metres without breaking shared edges or rings."""
+    projected = gpd.GeoSeries(geometries, crs="EPSG:4326").to_crs(METRIC_CRS)
+    polygonal = projected.geom_type.isin(["Polygon", "MultiPolygon"]).all()
+    if polygonal and hasattr(shapely, "coverage_simplify"):
+        # Neighbouring districts share their borders, so simplify the coverage as a whole (shapely >= 2.1)
+        simplified = shapely.coverage_simplify(projected.values, tolerance, simplify_boundary=True)
+    else:
+        simplified = shapely.simplify(projected.values, tolerance, preserve_topology=True)
+    return gpd.GeoSeries(simplified, crs=METRIC_CRS).to_crs("EPSG:4326").values
+
+
+def quantize_geometries(geometries, precision=PRECISION):
+    """Rounds every coordinate to precision decimal places, which also shortens how they are written out."""
+    return shapely.transform(geometries, lambda coords: np.round(coords, precision))
+
+
+def compact_geojson(data, tolerance=None, precision=PRECISION):
+    """Returns a copy of a GeoJSON FeatureCollection with simplified, quantized geometries."""
+    features = data['features']
+    geometries = np.array([shapely.geometry.shape(feature['geometry']) for feature in features], dtype=object)
+    if tolerance:
+        geometries = simplify_geometries(geometries, tolerance)
+    geometries = quantize_geometries(geometries, precision)
+
+    compact = {key: value for key, value in data.items() if key != 'features'}
+    compact['features'] = [
+        {"type": "Feature", "properties": feature['properties'], "geometry": shapely.geometry.mapping(geometry)}
+        for feature, geometry in zip(features, geometries)
+    ]
+    return compact
+
+
+def dumps_compact(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def time_json_loads(text, repeat=3):
+    """Returns the fastest of several json.loads timings, in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        json.loads(text)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def rendered_size(data):
+    """Returns the size of a folium page that draws data as one GeoJSON layer, i.e. what the browser receives."""
+    m = folium.Map(location=[52.52, 13.405], zoom_start=10)
+    folium.GeoJson(data).add_to(m)
+    return len(m.get_root().render().encode('utf-8'))
+
+
+def build_compact_assets(assets=ASSETS, data_dir=DATA_DIR, compact_dir=COMPACT_DIR, precision=PRECISION):
+    """Writes the compact variant of every asset into compact_dir and returns a before/after report per asset."""
+    compact_dir = Path(compact_dir)
+    compact_dir.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(compact_dir)
+    report = {}
+    for file_name, tolerance in assets.items():
+        source = Path(data_dir) / file_name
+        if not source.exists():
+            continue
+        original = source.read_text(encoding='utf-8')
+        data = json.loads(original)
+        compact = dumps_compact(compact_geojson(data, tolerance, precision))
+        (compact_dir / file_name).write_text(compact, encoding='utf-8')
+        manifest[file_name] = {**source_entry(source), "tolerance": tolerance, "precision": precision}
+        report[file_name] = {
+            "bytes": (len(original.encode('utf-8')), len(compact.encode('utf-8'))),
+            "parse_seconds": (time_json_loads(original), time_json_loads(compact)),
+            "rendered_bytes": (rendered_size(data), rendered_size(json.loads(compact))),
+        }
+    with open(compact_dir / MANIFEST_FILE, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    return report
+
+
+def print_report(report):
+    print(f"{'asset':<38}{'bytes':>24}{'parse ms':>18}{'rendered bytes':>26}")
+    for file_name, row in report.items():
+        (bytes_before, bytes_after), (parse_before, parse_after), (rendered_before, rendered_after) = row.values()
+        print(
+            f"{file_name:<38}"
+            f"{bytes_before:>11,} -> {bytes_after:>9,}"
+            f"{parse_before * 1000:>9.1f} -> {parse_after * 1000:>5.1f}"
+            f"{rendered_before:>13,} -> {rendered_after:>9,}"
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write simplified, quantized copies of the GeoJSON assets for the app.")
+    parser.add_argument("--output-dir", default=COMPACT_DIR, help="directory the compact files are written to")
+    parser.add_argument("--precision", type=int, default=PRECISION, help="decimal places kept per coordinate")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies every simplification tolerance")
+    args = parser.parse_args()
+
+    assets = {file_name: tolerance and tolerance * args.scale for file_name, tolerance in ASSETS.items()}
+    print_report(build_compact_assets(assets, compact_dir=args.output_dir, precision=args.precision))
@@ -0,0 +1,117 @@
+import threading
+from collections.abc import Mapping
+
+import geopandas as gpd
+
+import artifacts
+import district_index
+import get_crime
+import layer_partitions
+import map_layers
+import streaming_json
+import traffic_store
+
+# Loaded by warm_up in the background, ordered so that the first maps most sessions ask for come first
+HEAVY_DATASETS = ["Traffic Data", "Police Precincts", "crime_heat_data", "Streetlights"]
+
+
+class LazyPartitions(Mapping):
+    """Read-only {layer: partition} view that partitions a layer the first time it is looked up."""
+
+    def __init__(self, service):
+        self.service = service
+
+    def __getitem__(self, layer):
+        if layer not in layer_partitions.PARTITIONERS:
+            raise KeyError(layer)
+        return self.service.get(layer)
+
+    def __iter__(self):
+        return iter(layer_partitions.PARTITIONERS)
+
+    def __len__(self):
+        return len(layer_partitions.PARTITIONERS)
+
+
+class DataService:
+    """Loads every dataset of the map the first time it is needed and keeps it for all sessions of the process.
+
+    Has the same attributes as map_layers.MapData, so it can be passed wherever the map layers expect one;
+    a map served from the cache of rendered pages then loads nothing at all. Given the directory written by
+    artifacts.py, it reads the precomputed datasets from there instead of deriving them from the sources.
+    """
+
+    def __init__(self, artifacts_dir=None):
+        self.loaders = {
+            "districts": lambda: gpd.read_file(map_layers.DISTRICTS_FILE),
+            "streetlights": map_layers.load_streetlights,
+            "segment_data": lambda: traffic_store.TrafficStore(map_layers.TRAFFIC_STORE_DIR),
+            "police_precincts": map_layers.load_police_precincts,
+            "crime_data": get_crime.load_and_process_crime_data,
+            "crime_heat_data": lambda: get_crime.heat_data_by_year_and_type(self.crime_data),
+            "Police Precincts": lambda: layer_partitions.build_layer_partition("Police Precincts", self.police_precincts, self.districts),
+            # Streamed from the file, so only the segments inside Berlin are ever held in memory
+            "Traffic Data": lambda: district_index.stream_segments_by_district(streaming_json.iter_features(map_layers.TRAFFIC_FILE), self.districts),
+            "Streetlights": self.load_streetlight_partition,
+        }
+        if artifacts_dir is not None:
+            self.loaders.update(artifacts.loaders(artifacts_dir))
+        self.values = {}
+        # One lock per dataset, so a session waiting for the streetlights does not block one that needs the districts
+        self.locks = {name: threading.Lock() for name in self.loaders}
+        self.partitions = LazyPartitions(self)
+
+    def load_streetlight_partition(self):
+        """Returns None when the streetlights file has not been downloaded."""
+        if self.streetlights is None:
+            return None
+        return layer_partitions.build_layer_partition("Streetlights", self.streetlights, self.districts)
+
+    def get(self, name):
+        """Returns the dataset, loading it first if no session has needed it yet."""
+        if name not in self.values:
+            with self.locks[name]:
+                if name not in self.values:
+                    self.values[name] = self.loaders[name]()
+        return self.values[name]
+
+    def loaded(self):
+        return sorted(self.values)
+
+    def warm_up(self, names=HEAVY_DATASETS):
+        """Loads the given datasets in a daemon thread; sessions that need one earlier wait for it on its lock."""
+        def load_all():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    # The session that needs the dataset retries the load and shows the error
+                    print(f"Warming up {name} failed: {str(e)}")
+
+        thread = threading.Thread(target=load_all, name="data-service-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def districts(self):
+        return self.get("districts")
+
+    @property
+    def streetlights(self):
+        return self.get("streetlights")
+
+    @property
+    def segment_data(self):
+        return self.get("segment_data")
+
+    @property
+    def police_precincts(self):
+        return self.get("police_precincts")
+
+    @property
+    def crime_data(self):
+        return self.get("crime_data")
+
+    @property
+    def crime_heat_data(self):
+        return self.get("crime_heat_data")
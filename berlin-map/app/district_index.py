@@ -0,0 +1,68 @@
+import geopandas as gpd
+import shapely
+from shapely.geometry import shape
+
+import streaming_json
+
+
+def features_to_geodataframe(features, crs="EPSG:4326"):
+    """Builds a GeoDataFrame from GeoJSON features, remembering each feature's position in the list."""
+    geometries = [shape(feature['geometry']) for feature in features]
+    return gpd.GeoDataFrame({"feature_index": range(len(features))}, geometry=geometries, crs=crs)
+
+
+def points_by_district(coords, districts, crs="EPSG:4326"):
+    """Returns the (point position, Gemeinde_name) pairs for the (x, y) coordinates that lie inside a district."""
+    points = gpd.GeoDataFrame(
+        {"point_position": range(len(coords))},
+        geometry=gpd.points_from_xy(coords[:, 0], coords[:, 1]),
+        crs=crs
+    )
+    joined = gpd.sjoin(points, districts[["Gemeinde_name", "geometry"]], how="inner", predicate="within")
+    return joined[["point_position", "Gemeinde_name"]]
+
+
+def vertices_by_district(gdf, districts):
+    """Returns the (row position, Gemeinde_name) pairs for every row that has a vertex inside a district.
+
+    All vertices are collected into one point array and joined against the districts' spatial index,
+    so the cost no longer grows with the number of per-point geometry calls.
+    """
+    coords, row_positions = shapely.get_coordinates(gdf.geometry.values, return_index=True)
+    joined = points_by_district(coords, districts, crs=gdf.crs)
+    joined["row_position"] = row_positions[joined["point_position"].to_numpy()]
+    return joined[["row_position", "Gemeinde_name"]].drop_duplicates()
+
+
+def partition_by_district(gdf, districts, predicate="within"):
+    """Splits gdf into {Gemeinde_name: GeoDataFrame} with a single spatial join; a row may land in several districts."""
+    joined = gpd.sjoin(gdf, districts[["Gemeinde_name", "geometry"]], how="inner", predicate=predicate)
+    partitions = {name: gdf.iloc[0:0] for name in districts['Gemeinde_name'].unique()}
+    for name, rows in joined.groupby("Gemeinde_name"):
+        partitions[name] = rows.drop(columns=["index_right", "Gemeinde_name"]).sort_index()
+    return partitions
+
+
+def segments_by_district(traffic_geojson, districts):
+    """Maps every Gemeinde_name to the traffic segment features that have at least one vertex inside it."""
+    features = traffic_geojson['features']
+    segments = features_to_geodataframe(features, crs=districts.crs)
+    assignment = vertices_by_district(segments, districts)
+
+    segments_in_district = {name: [] for name in districts['Gemeinde_name'].unique()}
+    for row_position, name in assignment.sort_values("row_position").itertuples(index=False):
+        segments_in_district[name].append(features[row_position])
+    return segments_in_district
+
+
+def stream_segments_by_district(features, districts, chunk_size=streaming_json.CHUNK_SIZE):
+    """Like segments_by_district for an iterable of features, e.g. streaming_json.iter_features.
+
+    Features are indexed chunk by chunk and only the ones inside a district are kept, so a file covering
+    far more than Berlin never has to be held in memory as a whole.
+    """
+    segments_in_district = {name: [] for name in districts['Gemeinde_name'].unique()}
+    for chunk in streaming_json.iter_chunks(features, chunk_size):
+        for name, chunk_segments in segments_by_district({"features": chunk}, districts).items():
+            segments_in_district[name].extend(chunk_segments)
+    return segments_in_district
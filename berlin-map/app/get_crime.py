@@ -1,9 +1,16 @@
+import hashlib
+from pathlib import Path
+
 import pandas as pd
 import geopandas as gpd
+import shapely
+
 
+PATH = Path(__file__).parent / "Fallzahlen&HZ 2014-2023.xlsx"
+GEO_PATH = Path(__file__).parent / "bezirksgrenzen.geojson"
+CACHE_DIR = Path(__file__).parent / "crime_cache"
 
-PATH = r"Fallzahlen&HZ 2014-2023.xlsx"
-GEO_PATH = r"bezirksgrenzen.geojson"
+YEARS = range(2014, 2024)
 
 BEZIRKE = ["Mitte", "Friedrichshain-Kreuzberg", "Pankow", "Charlottenburg-Wilmersdorf", "Spandau", "Steglitz-Zehlendorf", "Tempelhof-Schöneberg", "Neukölln", "Treptow-Köpenick", "Marzahn-Hellersdorf", "Lichtenberg", "Reinickendorf"]
 STRAFTATEN = ["Bezeichnung (Bezirksregion)", "Straftaten \n-insgesamt-", "Raub", "Straßenraub,\nHandtaschen-raub", "Körper-verletzungen \n-insgesamt-", "Gefährl. und schwere Körper-verletzung", "Freiheits-beraubung, Nötigung,\nBedrohung, Nachstellung", "Diebstahl \n-insgesamt-"]
@@ -19,16 +26,33 @@ NEW_COLUMN_NAMES = {
     "Bezeichnung (Bezirksregion)": "Gemeinde_name"
 }
 
+# Crime count columns of the processed data, in the order they appear
+CRIME_TYPES = ["Gesamt", "Raub", "Straßenraub", "Körperverletzung", "schwere Körperverletzung", "Freiheitsberaubung", "Diebstahl", "Other"]
+
+# Bumped whenever the processed layout changes, so caches built by older code are not reused
+CACHE_VERSION = "2"
+
 COLUMNS_TO_SUBTRACT = ["Raub", "Körperverletzung", "schwere Körperverletzung", "Freiheitsberaubung", "Diebstahl"]
 
 
+def filter_data(df, year):
+    """Filters one year's sheet by relevant columns and districts."""
+    df_filtered = df[df["Bezeichnung (Bezirksregion)"].isin(BEZIRKE)][STRAFTATEN]
+    df_filtered["Jahr"] = year
+    return df_filtered.rename(columns=NEW_COLUMN_NAMES)
+
+
 def load_and_filter_data(year, path=PATH):
     """Loads data for a specific year, filters by relevant columns and districts."""
     sheet_name = f"Fallzahlen_{year}"
     df = pd.read_excel(path, sheet_name=sheet_name, skiprows=4)
-    df_filtered = df[df["Bezeichnung (Bezirksregion)"].isin(BEZIRKE)][STRAFTATEN]
-    df_filtered["Jahr"] = year
-    return df_filtered.rename(columns=NEW_COLUMN_NAMES)
+    return filter_data(df, year)
+
+
+def load_and_filter_all_years(years=YEARS, path=PATH):
+    """Loads every year's sheet while opening the workbook only once."""
+    sheets = pd.read_excel(path, sheet_name=[f"Fallzahlen_{year}" for year in years], skiprows=4)
+    return [filter_data(sheets[f"Fallzahlen_{year}"], year) for year in years]
 
 
 def calculate_other_crimes(df):
@@ -37,22 +61,78 @@ def calculate_other_crimes(df):
     return df
 
 
+def add_centroids(df_geo):
+    """Stores each district's centroid as centroid_lat/centroid_lon columns, computed once per district."""
+    centroids = shapely.centroid(df_geo.geometry.values)
+    df_geo["centroid_lat"] = shapely.get_y(centroids)
+    df_geo["centroid_lon"] = shapely.get_x(centroids)
+    return df_geo
+
+
 def merge_with_geo_data(df, geo_path=GEO_PATH):
     """Merges crime data with GeoJSON data, handles missing districts."""
-    df_geo = gpd.read_file(geo_path)
+    df_geo = add_centroids(gpd.read_file(geo_path))
     merged_df = df.merge(df_geo, on="Gemeinde_name", how="inner")
     merged_df = merged_df.drop(columns=["gml_id", "Gemeinde_schluessel", "Land_name", "Land_schluessel", "Schluessel_gesamt"])
     return gpd.GeoDataFrame(merged_df, geometry='geometry')
 
 
-def load_and_process_crime_data():
-    """Loads, processes, and returns the crime data."""
-    all_data = [load_and_filter_data(year) for year in range(2014, 2024)]
+def process_crime_data(path=PATH, geo_path=GEO_PATH):
+    """Loads and processes the crime data straight from the Excel workbook."""
+    all_data = load_and_filter_all_years(path=path)
     df_combined = pd.concat(all_data, ignore_index=True)
     df_combined = calculate_other_crimes(df_combined)
-    return merge_with_geo_data(df_combined)
+    return merge_with_geo_data(df_combined, geo_path)
+
+
+def source_hash(path=PATH, geo_path=GEO_PATH):
+    """Hashes the workbook and the district boundaries, which together determine the processed data."""
+    sha256 = hashlib.sha256(CACHE_VERSION.encode())
+    for source in (path, geo_path):
+        with open(source, "rb") as file:
+            sha256.update(file.read())
+    return sha256.hexdigest()[:16]
+
+
+def cache_path_for(path=PATH, geo_path=GEO_PATH, cache_dir=CACHE_DIR):
+    return Path(cache_dir) / f"crime_data_{source_hash(path, geo_path)}.parquet"
+
+
+def build_crime_cache(path=PATH, geo_path=GEO_PATH, cache_dir=CACHE_DIR):
+    """Converts the workbook into a GeoParquet file keyed by the sources' hash and removes outdated ones."""
+    cache_path = cache_path_for(path, geo_path, cache_dir)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    crime_data = process_crime_data(path, geo_path)
+    crime_data.to_parquet(cache_path)
+    for outdated in cache_path.parent.glob("crime_data_*.parquet"):
+        if outdated != cache_path:
+            outdated.unlink()
+    return cache_path
+
+
+def load_and_process_crime_data(path=PATH, geo_path=GEO_PATH, cache_dir=CACHE_DIR):
+    """Loads, processes, and returns the crime data, using the GeoParquet cache when it matches the sources."""
+    cache_path = cache_path_for(path, geo_path, cache_dir)
+    if not cache_path.exists():
+        try:
+            build_crime_cache(path, geo_path, cache_dir)
+        except OSError:
+            # Read-only deployments still work, they just parse the workbook every time
+            return process_crime_data(path, geo_path)
+    return gpd.read_parquet(cache_path)
+
+
+def heat_data_by_year_and_type(crime_data):
+    """Returns {(year, crime type): [[lat, lon, count], ...]} for every combination, skipping zero counts."""
+    heat_data = {}
+    for year, crime_data_in_year in crime_data.groupby("Jahr"):
+        for crime_type in CRIME_TYPES:
+            selected = crime_data_in_year[crime_data_in_year[crime_type] > 0]
+            heat_data[(int(year), crime_type)] = selected[["centroid_lat", "centroid_lon", crime_type]].to_numpy().tolist()
+    return heat_data
 
 
 if __name__ == "__main__":
+    print(f"Crime data cache written to {build_crime_cache()}")
     crime_data = load_and_process_crime_data()
     print(crime_data.head())  # Print the first 5 rows of the resulting GeoDataFrame
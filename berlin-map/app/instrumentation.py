@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Set BERLIN_MAP_TIMINGS=1 to record timings; everything below is a no-op otherwise
+ENABLED = os.environ.get("BERLIN_MAP_TIMINGS", "") not in ("", "0")
+
+# Port of the Prometheus text endpoint, only served when timings are enabled
+METRICS_PORT = int(os.environ.get("BERLIN_MAP_METRICS_PORT", "0"))
+
+logger = logging.getLogger("berlin_map.timings")
+
+
+def configure_logger():
+    """Sends the timings to stderr at INFO, since Streamlit only configures its own loggers.
+
+    The logger does not propagate, so a root logger another module configured does not print them twice.
+    """
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+if ENABLED:
+    configure_logger()
+
+
+class Measurement:
+    """One timed step; callers may set `features` and `bytes` inside the with block."""
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+        self.features = None
+        self.bytes = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        self.timings.records.append(self)
+        return False
+
+
+class NullMeasurement:
+    """Stands in for Measurement when timings are disabled, so instrumented code costs an attribute store."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_MEASUREMENT = NullMeasurement()
+
+
+class Timings:
+    """Wall times, feature counts and page sizes recorded during one rerun of the app."""
+
+    def __init__(self, enabled=ENABLED):
+        self.enabled = enabled
+        self.records = []
+        self.start = time.perf_counter()
+
+    def measure(self, name):
+        return Measurement(self, name) if self.enabled else NULL_MEASUREMENT
+
+    def rows(self):
+        return [
+            {"step": record.name, "ms": round(record.seconds * 1000, 3), "features": record.features, "bytes": record.bytes}
+            for record in self.records
+        ]
+
+    def finish(self, **context):
+        """Logs the rerun as one JSON line and adds it to the totals served on the metrics endpoint."""
+        if not self.enabled:
+            return
+        total = time.perf_counter() - self.start
+        logger.info(json.dumps({"event": "rerun", "total_ms": round(total * 1000, 3), **context, "steps": self.rows()}, default=str))
+        METRICS.add(self.records, total)
+
+
+# Timings used where no rerun is being measured, e.g. when maps are pre-rendered offline
+DISABLED = Timings(enabled=False)
+
+
+class Metrics:
+    """Process-wide totals per step, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = {}
+        self.counts = {}
+        self.last_bytes = {}
+        self.reruns = 0
+        self.rerun_seconds = 0.0
+
+    def add(self, records, total):
+        with self.lock:
+            self.reruns += 1
+            self.rerun_seconds += total
+            for record in records:
+                self.seconds[record.name] = self.seconds.get(record.name, 0.0) + record.seconds
+                self.counts[record.name] = self.counts.get(record.name, 0) + 1
+                if record.bytes is not None:
+                    self.last_bytes[record.name] = record.bytes
+
+    def render(self):
+        with self.lock:
+            lines = [
+                "# TYPE berlin_map_rerun_seconds summary",
+                f"berlin_map_rerun_seconds_sum {self.rerun_seconds}",
+                f"berlin_map_rerun_seconds_count {self.reruns}",
+                "# TYPE berlin_map_step_seconds summary",
+            ]
+            for name in sorted(self.seconds):
+                lines.append(f'berlin_map_step_seconds_sum{{step="{name}"}} {self.seconds[name]}')
+                lines.append(f'berlin_map_step_seconds_count{{step="{name}"}} {self.counts[name]}')
+            lines.append("# TYPE berlin_map_step_bytes gauge")
+            for name in sorted(self.last_bytes):
+                lines.append(f'berlin_map_step_bytes{{step="{name}"}} {self.last_bytes[name]}')
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serves METRICS on http://<host>:port/metrics from a daemon thread; returns None when disabled or the port is taken."""
+    if not ENABLED or not port:
+        return None
+    try:
+        server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    except OSError as e:
+        # Another process holds the port; the app keeps running, only without the endpoint
+        logger.warning(f"Serving metrics on port {port} failed: {str(e)}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,28 @@
+import district_index
+import streetlights as streetlight_lod
+
+# Functions that assign one layer's source data to the districts
+PARTITIONERS = {
+    "Police Precincts": district_index.partition_by_district,
+    "Traffic Data": district_index.segments_by_district,
+    "Streetlights": streetlight_lod.build_streetlight_lod,
+}
+
+
+def build_layer_partition(layer, source, districts):
+    """Runs the spatial assignment of a single layer, so layers can be partitioned when they are first shown."""
+    return PARTITIONERS[layer](source, districts)
+
+
+def build_layer_partitions(districts, police_precincts, traffic_geojson, streetlights):
+    """Runs every spatial assignment the map layers need once, keyed by layer name and then Gemeinde_name.
+
+    Police precincts become GeoDataFrames, traffic segments lists of GeoJSON features and streetlights the
+    level-of-detail entries of streetlights.build_streetlight_lod. Layers passed as None are left out.
+    """
+    sources = {"Police Precincts": police_precincts, "Traffic Data": traffic_geojson, "Streetlights": streetlights}
+    return {
+        layer: build_layer_partition(layer, source, districts)
+        for layer, source in sources.items()
+        if source is not None
+    }
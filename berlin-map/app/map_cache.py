@@ -0,0 +1,119 @@
+import argparse
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import get_crime
+import instrumentation
+import layer_partitions
+import map_layers
+import traffic_store
+
+RENDERED_MAPS_DIR = Path(__file__).parent / 'rendered_maps'
+
+# Bumped whenever map_layers draws differently, so pages rendered by older code are not served
+RENDER_VERSION = "4"
+
+
+def data_version():
+    """Hashes every input the maps are drawn from, so pre-rendered pages are only used with the data they show."""
+    sha256 = hashlib.sha256(RENDER_VERSION.encode())
+    sources = [
+        map_layers.DISTRICTS_FILE,
+        map_layers.STREETLIGHTS_FILE,
+        map_layers.TRAFFIC_FILE,
+        map_layers.POLICE_PRECINCTS_FILE,
+        map_layers.TRAFFIC_STORE_DIR / traffic_store.AVERAGES_FILE,
+        map_layers.TRAFFIC_STORE_DIR / traffic_store.SEGMENT_IDS_FILE,
+        map_layers.TRAFFIC_STORE_DIR / traffic_store.WEEKS_FILE,
+        map_layers.TRAFFIC_STORE_DIR / traffic_store.CUBE_SUMS_FILE,
+        map_layers.TRAFFIC_STORE_DIR / traffic_store.CUBE_COUNTS_FILE,
+    ]
+    for source in sources:
+        if source.exists():
+            with open(source, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    sha256.update(chunk)
+    sha256.update(get_crime.source_hash().encode())
+    return sha256.hexdigest()[:16]
+
+
+def key_filename(key):
+    return hashlib.sha1(repr(key).encode()).hexdigest() + '.html'
+
+
+class MapCache:
+    """Bounded LRU cache of rendered map pages, backed by an optional directory of pre-rendered pages.
+
+    Only pages rendered by this process take up room in the LRU; pre-rendered ones are read from their file
+    on every hit.
+    """
+
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = Path(directory) if directory else None
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.pages:
+                self.pages.move_to_end(key)
+                self.hits += 1
+                return self.pages[key]
+        if self.directory is not None:
+            file_path = self.directory / key_filename(key)
+            if file_path.exists():
+                # Not copied into the LRU: the OS page cache already holds the file, shared by all processes
+                page = file_path.read_text(encoding='utf-8')
+                with self.lock:
+                    self.hits += 1
+                return page
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, page):
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.maxsize:
+                self.pages.popitem(last=False)
+
+    def get_or_render(self, key, data, timings=instrumentation.DISABLED):
+        """Returns the cached page for key, rendering and caching it on a miss."""
+        with timings.measure("map_cache_lookup"):
+            page = self.get(key)
+        if page is None:
+            page = map_layers.render_map(data, key, timings)
+            self.put(key, page)
+        return page
+
+
+def warm_up(output_dir=RENDERED_MAPS_DIR):
+    """Pre-renders every district, layer and parameter combination into output_dir/<data version>/."""
+    data = map_layers.load_map_data()
+    directory = Path(output_dir) / data_version()
+    directory.mkdir(parents=True, exist_ok=True)
+
+    start = time.perf_counter()
+    count = total_bytes = 0
+    for key in map_layers.all_map_keys(data):
+        if key[1] in layer_partitions.PARTITIONERS and key[1] not in data.partitions:
+            continue
+        page = map_layers.render_map(data, key)
+        (directory / key_filename(key)).write_text(page, encoding='utf-8')
+        count += 1
+        total_bytes += len(page.encode('utf-8'))
+    print(f"Rendered {count} maps ({total_bytes / 1e6:.1f} MB) into {directory} in {time.perf_counter() - start:.1f} s")
+    return directory
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pre-render every map the app can show.")
+    parser.add_argument("--output-dir", default=RENDERED_MAPS_DIR, help="directory the pages are written to")
+    args = parser.parse_args()
+    warm_up(args.output_dir)
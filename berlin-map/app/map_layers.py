@@ -0,0 +1,337 @@
+import json
+from collections import namedtuple
+from pathlib import Path
+
+import folium
+import geopandas as gpd
+from branca.element import MacroElement
+from folium.plugins import HeatMap
+from jinja2 import Template
+
+import compact_geojson
+import get_crime
+import instrumentation
+import layer_partitions
+import streetlights as streetlight_lod
+import traffic_store
+import vector_tiles
+
+DATA_DIR = Path(__file__).parent
+# Prefer the simplified, quantized copies written by compact_geojson.py
+DISTRICTS_FILE = compact_geojson.compact_path(DATA_DIR / 'bezirksgrenzen.geojson')
+STREETLIGHTS_FILE = compact_geojson.compact_path(DATA_DIR / 'pruned_streetlight.geojson')
+TRAFFIC_FILE = compact_geojson.compact_path(DATA_DIR / 'converted_telraam_segments.geojson')
+TRAFFIC_STORE_DIR = DATA_DIR / 'traffic_store'
+POLICE_PRECINCTS_FILE = compact_geojson.compact_path(DATA_DIR / 'converted_police_precincts.geojson')
+
+LAYERS = ["Crime Heat Map", "Crime Data", "Traffic Data", "Streetlights", "Police Precincts"]
+HOURS = range(24)
+
+# Prefix of the keys of maps that load their layers from the vector tile pyramid
+VECTOR_TILES = "Vector Tiles"
+
+# Vector tile layers that replace the inline GeoJSON of the map layers
+TILE_LAYER_NAMES = {"Traffic Data": "traffic_segments", "Streetlights": "streetlights", "Police Precincts": "police_precincts"}
+
+# Everything the layers are drawn from; app.py fills it from its cached loaders
+MapData = namedtuple("MapData", ["districts", "partitions", "segment_data", "crime_data", "crime_heat_data"])
+
+
+def load_police_precincts(file_path=POLICE_PRECINCTS_FILE):
+    return gpd.read_file(file_path)
+
+
+def load_streetlights(file_path=STREETLIGHTS_FILE):
+    """Returns the streetlights, or None when their file has not been downloaded (it is not in the repository)."""
+    if not Path(file_path).exists():
+        print(f"Skipping the streetlights: {file_path} is missing")
+        return None
+    return gpd.read_file(file_path)
+
+
+def load_map_data():
+    """Loads every dataset without Streamlit, e.g. for pre-rendering maps offline.
+
+    The streetlights are left out of the partitions when their file is missing.
+    """
+    districts = gpd.read_file(DISTRICTS_FILE)
+    streetlights = load_streetlights()
+    with open(TRAFFIC_FILE, 'r') as file:
+        traffic_geojson = json.load(file)
+    partitions = layer_partitions.build_layer_partitions(districts, load_police_precincts(), traffic_geojson, streetlights)
+    crime_data = get_crime.load_and_process_crime_data()
+    return MapData(
+        districts=districts,
+        partitions=partitions,
+        segment_data=traffic_store.TrafficStore(TRAFFIC_STORE_DIR),
+        crime_data=crime_data,
+        crime_heat_data=get_crime.heat_data_by_year_and_type(crime_data)
+    )
+
+
+def map_key(selected_district, selected_layer, selected_hour=None, selected_year=None, selected_crime_type=None, selected_weekdays=None, selected_weeks=None):
+    """Returns the inputs that determine a map, leaving out the ones the selected layer ignores.
+
+    selected_weekdays (a tuple of days, 0 = Monday) and selected_weeks (a (first, last) tuple of ISO week
+    Mondays) are only part of the key when they narrow the traffic averages down, so the default maps keep
+    the keys they are pre-rendered under.
+    """
+    if selected_layer == "Crime Heat Map":
+        # The heat map always shows all districts
+        return (None, selected_layer, selected_year, selected_crime_type)
+    if selected_layer == "Crime Data":
+        return (selected_district, selected_layer, selected_year)
+    if selected_layer == "Traffic Data":
+        if selected_weekdays is None and selected_weeks is None:
+            return (selected_district, selected_layer, selected_hour)
+        return (selected_district, selected_layer, selected_hour, selected_weekdays, selected_weeks)
+    return (selected_district, selected_layer)
+
+
+def tiled_key(key):
+    """Returns the key of the same map drawn from vector tiles instead of inline GeoJSON."""
+    return (VECTOR_TILES,) + key
+
+
+def all_map_keys(data):
+    """Yields the key of every map the sidebar can produce."""
+    years = sorted(int(year) for year in data.crime_data["Jahr"].unique())
+    for year in years:
+        for crime_type in get_crime.CRIME_TYPES:
+            yield map_key(None, "Crime Heat Map", selected_year=year, selected_crime_type=crime_type)
+    for selected_district in data.districts['Gemeinde_name'].unique():
+        for year in years:
+            yield map_key(selected_district, "Crime Data", selected_year=year)
+        for hour in HOURS:
+            yield map_key(selected_district, "Traffic Data", selected_hour=hour)
+        yield map_key(selected_district, "Streetlights")
+        yield map_key(selected_district, "Police Precincts")
+
+
+def create_base_map(districts, selected_district, use_tiles=False):
+    """Creates a map showing all districts (selected_district=None) or zoomed to one district."""
+    if selected_district is None:
+        bounds = districts.total_bounds
+        m = folium.Map(
+            location=[(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2],  # Center of the bounds
+            zoom_start=10
+        )
+        # Add all district boundaries to the map
+        if not use_tiles:
+            folium.GeoJson(districts).add_to(m)
+    else:
+        district = districts[districts['Gemeinde_name'] == selected_district]
+        bounds = district.total_bounds
+        m = folium.Map(
+            location=[(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2],
+            zoom_start=12
+        )
+        if not use_tiles:
+            folium.GeoJson(district).add_to(m)
+    if use_tiles:
+        vector_tiles.add_tile_layer(m, "districts", selected_district)
+    return m
+
+
+def add_crime_heat_map(m, crime_heat_data, selected_year, selected_crime_type):
+    # Look up the precomputed heat map points for the selected year and crime type
+    heat_data = crime_heat_data[(selected_year, selected_crime_type)]
+
+    # Add heat map to the map
+    HeatMap(heat_data).add_to(m)
+
+
+def add_crime_data(m, crime_data, selected_district, selected_year):
+    crime_data_in_district = crime_data[(crime_data['Gemeinde_name'] == selected_district) & (crime_data['Jahr'] == selected_year)]
+
+    # Add crime data to the map
+    for _, row in crime_data_in_district.iterrows():
+        coords = (row['centroid_lat'], row['centroid_lon'])
+        popup_html = f"<b>Crime Data ({row['Jahr']})</b><br>"
+        popup_html += f"<b>Total Crimes:</b> {row['Gesamt']}<br>"
+        popup_html += f"<b>Robbery:</b> {row['Raub']}<br>"
+        popup_html += f"<b>Street Robbery:</b> {row['Straßenraub']}<br>"
+        popup_html += f"<b>Assault:</b> {row['Körperverletzung']}<br>"
+        popup_html += f"<b>Serious Assault:</b> {row['schwere Körperverletzung']}<br>"
+        popup_html += f"<b>Deprivation of Liberty:</b> {row['Freiheitsberaubung']}<br>"
+        popup_html += f"<b>Theft:</b> {row['Diebstahl']}<br>"
+        popup_html += f"<b>Other Crimes:</b> {row['Other']}<br>"
+
+        folium.Marker(
+            location=coords,
+            popup=folium.Popup(popup_html, max_width=500),
+            icon=folium.Icon(color='green', icon='info-sign')
+        ).add_to(m)
+
+
+def add_traffic_data(m, traffic_segments_in_district, segment_data, selected_hour, selected_weekdays=None, selected_weeks=None):
+    # Describe the days the averages cover when they are narrowed down
+    period = ""
+    if selected_weekdays is not None:
+        period += f"Days: {', '.join(traffic_store.DAYS_OF_WEEK[day] for day in selected_weekdays)}<br>"
+    if selected_weeks is not None:
+        period += f"Weeks: {selected_weeks[0]} to {selected_weeks[1]}<br>"
+
+    for feature in traffic_segments_in_district:
+        coordinates = feature['geometry']['coordinates']
+        segment_id = str(feature['properties']['segment_id'])
+
+        # Get traffic data for the segment from the traffic store
+        if segment_id in segment_data:
+            data_hour = segment_data.hourly_averages(segment_id, selected_hour, selected_weekdays, selected_weeks)
+
+            # Check if selected hour data is available
+            if data_hour is not None:
+                avg_car = round(data_hour.get('avg_car', 0))
+                avg_bike = round(data_hour.get('avg_bike', 0))
+                avg_pedestrian = round(data_hour.get('avg_pedestrian', 0))
+
+                # Add LineString to the map with traffic data pop-up
+                folium.PolyLine(
+                    locations=[(coord[1], coord[0]) for coord in coordinates],
+                    color='blue',
+                    weight=5,
+                    popup=folium.Popup(
+                        f"Segment ID: {segment_id}<br>"
+                        f"Hour: {selected_hour}<br>"
+                        f"{period}"
+                        f"Cars: {avg_car}<br>"
+                        f"Bikes: {avg_bike}<br>"
+                        f"Pedestrians: {avg_pedestrian}<br>",
+                        max_width=500
+                    )
+                ).add_to(m)
+
+
+def add_police_precincts(m, police_in_district):
+    for _, precinct in police_in_district.iterrows():
+        popup_html = f"<b>Police Precinct</b><br>"
+        popup_html += f"<b>Address:</b> {precinct['text']}, {precinct['locatorDesignator']}, {precinct['postCode']}<br>"
+        popup_html += f"<b>Phone:</b> {precinct['telephoneVoice']}<br>"
+        popup_html += f"<b>Website:</b> <a href='{precinct['website']}' target='_blank'>{precinct['website']}</a><br>"
+
+        # Extract coordinates from geometry
+        coordinates = precinct.geometry.coords[0]
+        lat, lon = coordinates[1], coordinates[0]
+
+        # Add marker to the map
+        folium.Marker(
+            location=[lat, lon],
+            popup=folium.Popup(popup_html, max_width=500),
+            icon=folium.Icon(color='red', icon='shield')
+        ).add_to(m)
+
+
+class StreetlightDetail(MacroElement):
+    """Swaps the density cells for the single streetlights in view once the map is zoomed in far enough.
+
+    The streetlights are drawn on a canvas and only for the current view, so the number of Leaflet objects
+    stays bounded however many lights the district has.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function() {
+                var map = {{ this.map_name }};
+                var cells = {{ this.cells_name }};
+                var detail = {{ this.detail|tojson }};
+                var renderer = L.canvas();
+                var points = L.layerGroup();
+                function update() {
+                    points.clearLayers();
+                    if (map.getZoom() < {{ this.detail_zoom }}) {
+                        map.removeLayer(points);
+                        if (!map.hasLayer(cells)) { cells.addTo(map); }
+                        return;
+                    }
+                    map.removeLayer(cells);
+                    var bounds = map.getBounds().pad(0.2);
+                    var c = detail.coordinates;
+                    for (var i = 0; i < c.length; i += 2) {
+                        var latlng = L.latLng(detail.origin[1] + c[i + 1] / detail.scale, detail.origin[0] + c[i] / detail.scale);
+                        if (bounds.contains(latlng)) {
+                            L.circleMarker(latlng, {renderer: renderer, radius: 2, weight: 1, color: 'yellow', fill: true, fillColor: 'yellow', fillOpacity: 1}).addTo(points);
+                        }
+                    }
+                    points.addTo(map);
+                }
+                map.on('zoomend moveend', update);
+                update();
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, detail, cells, map_name, detail_zoom=streetlight_lod.DETAIL_ZOOM):
+        super().__init__()
+        self._name = "StreetlightDetail"
+        self.detail = detail
+        self.cells_name = cells.get_name()
+        self.map_name = map_name
+        self.detail_zoom = detail_zoom
+
+
+def add_streetlights(m, streetlights_in_district):
+    if streetlights_in_district["points"] is not None:
+        # Few enough streetlights to draw each one, as a single GeoJSON layer instead of one marker per point
+        folium.GeoJson(
+            streetlights_in_district["points"],
+            marker=folium.CircleMarker(radius=0.5, color='yellow', fill=True, fill_color='yellow')
+        ).add_to(m)
+    elif streetlights_in_district["cells"] is not None:
+        # Otherwise draw the density grid while zoomed out, and the streetlights in view once zoomed in
+        cells = folium.GeoJson(
+            streetlights_in_district["cells"],
+            style_function=lambda feature: {
+                'fillColor': 'yellow',
+                'color': 'yellow',
+                'weight': 0,
+                'fillOpacity': feature['properties']['opacity']
+            },
+            tooltip=folium.GeoJsonTooltip(fields=['count'], aliases=['Streetlights:'])
+        ).add_to(m)
+        if streetlights_in_district.get("detail") is not None:
+            StreetlightDetail(streetlights_in_district["detail"], cells, m.get_name()).add_to(m)
+
+
+def build_map(data, key):
+    """Builds the folium map for a key returned by map_key or tiled_key."""
+    use_tiles = key[0] == VECTOR_TILES
+    selected_district, selected_layer, *parameters = key[1:] if use_tiles else key
+    m = create_base_map(data.districts, selected_district, use_tiles)
+
+    # Add the selected layer to the map; the tiles only carry the averages over all days
+    if use_tiles and selected_layer in TILE_LAYER_NAMES and not any(parameters[1:]):
+        vector_tiles.add_tile_layer(m, TILE_LAYER_NAMES[selected_layer], selected_district, *parameters[:1])
+    elif selected_layer == "Crime Heat Map":
+        add_crime_heat_map(m, data.crime_heat_data, *parameters)
+    elif selected_layer == "Crime Data":
+        add_crime_data(m, data.crime_data, selected_district, *parameters)
+    elif selected_layer == "Traffic Data":
+        add_traffic_data(m, data.partitions["Traffic Data"][selected_district], data.segment_data, *parameters)
+    elif selected_layer == "Police Precincts":
+        add_police_precincts(m, data.partitions["Police Precincts"][selected_district])
+    elif selected_layer == "Streetlights":
+        add_streetlights(m, data.partitions["Streetlights"][selected_district])
+    return m
+
+
+def feature_count(data, key):
+    """Returns how many features the layer of key draws, for the timings."""
+    selected_district, selected_layer, *parameters = key[1:] if key[0] == VECTOR_TILES else key
+    if selected_layer == "Crime Heat Map":
+        return len(data.crime_heat_data[tuple(parameters)])
+    if selected_layer == "Crime Data":
+        return int(((data.crime_data['Gemeinde_name'] == selected_district) & (data.crime_data['Jahr'] == parameters[0])).sum())
+    if selected_layer == "Streetlights":
+        return data.partitions["Streetlights"][selected_district]["count"]
+    return len(data.partitions[selected_layer][selected_district])
+
+
+def render_map(data, key, timings=instrumentation.DISABLED):
+    """Returns the map for key as a standalone HTML page."""
+    with timings.measure("build_map"):
+        m = build_map(data, key)
+    with timings.measure("render_html") as measurement:
+        page = m.get_root().render()
+        measurement.bytes = len(page)
+    return page
@@ -0,0 +1,51 @@
+from functools import lru_cache
+
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
+
+
+@lru_cache(maxsize=None)
+def get_transformer(source_crs, target_crs):
+    """Returns a shared lon/lat-ordered transformer, since creating one costs far more than a small transform."""
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+def transform_coordinates(x, y, source_crs, target_crs):
+    """Transforms arrays of x and y (lon and lat for geographic CRSs) in a single pyproj call."""
+    return get_transformer(source_crs, target_crs).transform(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+
+
+def reproject_geometries(geometries, source_crs, target_crs):
+    """Reprojects an array of shapely geometries of any type, transforming all their coordinates at once."""
+    def transform(coords):
+        x, y = transform_coordinates(coords[:, 0], coords[:, 1], source_crs, target_crs)
+        return np.column_stack([x, y])
+
+    return shapely.transform(np.asarray(geometries, dtype=object), transform)
+
+
+def crs_member(crs):
+    """Returns the GeoJSON "crs" member naming crs, using the CRS84 URN for WGS84 like the Berlin open data files."""
+    crs = CRS.from_user_input(crs)
+    if crs.equals(CRS.from_epsg(4326), ignore_axis_order=True):
+        name = "urn:ogc:def:crs:OGC:1.3:CRS84"
+    else:
+        authority, code = crs.to_authority()
+        name = f"urn:ogc:def:crs:{authority}::{code}"
+    return {"type": "name", "properties": {"name": name}}
+
+
+def reproject_geojson(data, source_crs, target_crs):
+    """Returns a copy of a GeoJSON FeatureCollection in target_crs, with a "crs" member that says so."""
+    features = data['features']
+    geometries = [shapely.geometry.shape(feature['geometry']) if feature['geometry'] else None for feature in features]
+    reprojected = reproject_geometries(geometries, source_crs, target_crs)
+
+    converted = {key: value for key, value in data.items() if key != 'features'}
+    converted['crs'] = crs_member(target_crs)
+    converted['features'] = [
+        {**feature, "geometry": shapely.geometry.mapping(geometry) if geometry is not None else None}
+        for feature, geometry in zip(features, reprojected)
+    ]
+    return converted
@@ -1,59 +1,160 @@
 import os
 import json
-from datetime import datetime, timezone
+import hashlib
+import argparse
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import traffic_store
+import streaming_json
+from traffic_aggregation import CubeAccumulator, HourlyAccumulator
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+# Cached aggregates of previous runs, keyed by file name
+MANIFEST_FILE = Path(__file__).parent / 'segment_traffic_manifest.json'
 
-# Function to process the fetched data
-def process_traffic_data(data):
-    hourly_traffic = {hour: {"car": [], "bike": [], "pedestrian": []} for hour in range(24)}
+# Binary copies of the cached cubes, referenced from the manifest by file name and hash; as nested JSON
+# lists they made loading and rewriting the manifest the slowest part of a run with nothing to do
+CUBE_CACHE_DIR = Path(__file__).parent / 'segment_cube_cache'
 
-    for report in data.get('report', []):
-        dt = datetime.fromisoformat(report['date'].replace("Z", "+00:00"))
-        hour = dt.hour
-        hourly_traffic[hour]["car"].append(report['car'])
-        hourly_traffic[hour]["bike"].append(report['bike'])
-        hourly_traffic[hour]["pedestrian"].append(report['pedestrian'])
+# Function to process a single segment file, returns its content hash, hourly averages and traffic cube
+def process_segment_file(file_path):
+    # Stream the reports into the accumulators in chunks, so memory does not grow with the file's length
+    hourly, cube = HourlyAccumulator(), CubeAccumulator()
+    for reports in streaming_json.iter_chunks(streaming_json.iter_reports(file_path)):
+        hourly.add(reports)
+        cube.add(reports)
+    averages = hourly.averages() if cube.weeks else None
+    return file_hash(file_path), averages, cube.cube()
 
-    averages = {hour: {
-        "avg_car": sum(values["car"]) / len(values["car"]) if values["car"] else 0,
-        "avg_bike": sum(values["bike"]) / len(values["bike"]) if values["bike"] else 0,
-        "avg_pedestrian": sum(values["pedestrian"]) / len(values["pedestrian"]) if values["pedestrian"] else 0
-    } for hour, values in hourly_traffic.items()}
+# Function to hash a file without loading it into memory at once
+def file_hash(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
-    return averages
+def load_manifest(manifest_path):
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+def save_manifest(manifest, manifest_path):
+    with open(manifest_path, 'w') as file:
+        json.dump(manifest, file)
+
+# Function to write a segment's cube to the cache, returns the manifest reference to it
+def save_cube(cube, filename, cube_dir):
+    if cube is None:
+        return None
+    cube_dir.mkdir(parents=True, exist_ok=True)
+    cube_path = cube_dir / (Path(filename).stem + '.npz')
+    # Same dtypes as the store, so reading the cache back gives the same store as a full run
+    np.savez(
+        cube_path,
+        weeks=np.array(cube["weeks"]),
+        sums=np.asarray(cube["sums"], dtype=np.float32),
+        counts=np.asarray(cube["counts"], dtype=np.uint8)
+    )
+    return {"file": cube_path.name, "sha256": file_hash(cube_path)}
+
+def load_cube(reference, cube_dir):
+    if reference is None:
+        return None
+    with np.load(cube_dir / reference["file"]) as cube:
+        return {name: cube[name] for name in ("weeks", "sums", "counts")}
+
+# Function to check whether a manifest entry still describes the file on disk and its cached cube
+def is_unchanged(entry, file_path, stat, cube_dir):
+    # Entries written before the cube cache existed have to be reprocessed once
+    if entry is None or entry["size"] != stat.st_size or "cube_file" not in entry:
+        return False
+    reference = entry["cube_file"]
+    if reference is not None:
+        cube_path = cube_dir / reference["file"]
+        if not cube_path.exists() or file_hash(cube_path) != reference["sha256"]:
+            return False
+    if entry["mtime_ns"] == stat.st_mtime_ns:
+        return True
+    # The file was touched (e.g. by a fresh checkout), only its content decides
+    return entry["sha256"] == file_hash(file_path)
 
 # Function to fetch and process data for all segments
-def fetch_and_process_all_segments(data_folder):
+def fetch_and_process_all_segments(data_folder, workers=None, manifest_path=None, full=False, cube_dir=CUBE_CACHE_DIR):
+    """Aggregates every segment file in data_folder, fanning the work out over `workers` processes.
+
+    When manifest_path is given, files whose size and mtime (or content hash) match the manifest reuse
+    their cached averages and the cubes cached in cube_dir, and the manifest is rewritten afterwards.
+    full=True reprocesses every file.
+    """
+    cube_dir = Path(cube_dir)
+    manifest = {} if full else load_manifest(manifest_path)
+    new_manifest = {}
     all_segments_data = {}
-    
+    changed_files = []
+
     # Iterate through JSON files in the specified folder
-    for filename in os.listdir(data_folder):
+    for filename in sorted(os.listdir(data_folder)):
         if filename.endswith(".json"):
-            segment_id = filename.split('.')[0]  # Assuming the segment ID is the file name without extension
             file_path = os.path.join(data_folder, filename)
-            
-            with open(file_path, 'r') as file:
-                data = json.load(file)
-                
-            if data:
-                averages = process_traffic_data(data)
-                all_segments_data[segment_id] = {
-                    "averages": averages,
-                }
+            stat = os.stat(file_path)
+            entry = manifest.get(filename)
+
+            if is_unchanged(entry, file_path, stat, cube_dir):
+                new_manifest[filename] = dict(entry, mtime_ns=stat.st_mtime_ns)
+            else:
+                changed_files.append((filename, file_path, stat))
+
+    logging.debug(f"{len(new_manifest)} segments unchanged, {len(changed_files)} to process")
+
+    file_paths = [file_path for _, file_path, _ in changed_files]
+    if workers == 1 or len(file_paths) < 2:
+        results = map(process_segment_file, file_paths)
+        processed = list(zip(changed_files, results))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            processed = list(zip(changed_files, executor.map(process_segment_file, file_paths)))
+
+    # Without a manifest nothing is cached, so the cubes of this run are only kept in memory
+    cubes = {}
+    for (filename, _, stat), (sha256, averages, cube) in processed:
+        cubes[filename] = cube
+        new_manifest[filename] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": sha256,
+            "averages": averages,
+            "cube_file": save_cube(cube, filename, cube_dir) if manifest_path is not None else None
+        }
+
+    for filename, entry in sorted(new_manifest.items()):
+        if entry["averages"]:
+            segment_id = filename.split('.')[0]  # Assuming the segment ID is the file name without extension
+            all_segments_data[segment_id] = {
+                "averages": {int(hour): values for hour, values in entry["averages"].items()},
+                "cube": cubes[filename] if filename in cubes else load_cube(entry["cube_file"], cube_dir),
+            }
+
+    if manifest_path is not None:
+        save_manifest(new_manifest, manifest_path)
 
     return all_segments_data
 
 if __name__ == '__main__':
-    data_folder = "segment_traffic_data"  # Path to the folder containing the JSON files
+    parser = argparse.ArgumentParser(description="Aggregate the downloaded Telraam reports into the traffic store.")
+    parser.add_argument("--data-folder", default="segment_traffic_data", help="folder containing the per-segment JSON files")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument("--full", action="store_true", help="ignore cached aggregates and reprocess every file")
+    args = parser.parse_args()
+
+    # Set up logging
+    logging.basicConfig(level=logging.DEBUG)
     logging.debug("Starting to fetch and process all segments")
-    segments_data = fetch_and_process_all_segments(data_folder)
-    logging.debug(f"All segments data fetched and processed: {segments_data}")
+    segments_data = fetch_and_process_all_segments(args.data_folder, workers=args.workers, manifest_path=MANIFEST_FILE, full=args.full)
+    logging.debug(f"All segments data fetched and processed: {len(segments_data)} segments")
     
-    # Save the processed data to a new JSON file
-    output_file = 'fetched_segments_data.json'
-    with open(output_file, 'w') as file:
-        json.dump(segments_data, file, indent=4)
-    logging.debug(f"Data written to {output_file}")
+    # Save the processed data as a columnar store that the app can memory-map
+    output_dir = traffic_store.write_traffic_store(segments_data)
+    logging.debug(f"Data written to {output_dir}")
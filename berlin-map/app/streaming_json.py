@@ -0,0 +1,44 @@
+import json
+from itertools import islice
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Number of items handed to the aggregation and indexing stages at a time
+CHUNK_SIZE = 1000
+
+
+def iter_items(file_path, prefix):
+    """Yields the items of the array at prefix (ijson notation, e.g. "features.item") one at a time.
+
+    With ijson installed only the current item is held in memory. Without it the whole file is parsed
+    with json.load first, so results are the same but memory is no longer bounded.
+    """
+    with open(file_path, 'rb') as file:
+        if ijson is not None:
+            # Numbers come back as floats, like json.load, instead of ijson's default Decimals
+            yield from ijson.items(file, prefix, use_float=True)
+            return
+        data = json.load(file)
+    for key in prefix.split('.')[:-1]:
+        data = data.get(key, []) if isinstance(data, dict) else []
+    yield from data
+
+
+def iter_features(file_path):
+    """Yields the features of a GeoJSON FeatureCollection."""
+    return iter_items(file_path, 'features.item')
+
+
+def iter_reports(file_path):
+    """Yields the rows of a Telraam traffic report file."""
+    return iter_items(file_path, 'report.item')
+
+
+def iter_chunks(items, size=CHUNK_SIZE):
+    """Groups an iterable into lists of at most size items."""
+    items = iter(items)
+    while chunk := list(islice(items, size)):
+        yield chunk
@@ -0,0 +1,73 @@
+import numpy as np
+import shapely
+
+import district_index
+
+# Districts with more streetlights than this are drawn as aggregated grid cells until the map is zoomed in
+MAX_POINTS = 2000
+
+# Zoom level from which large districts switch from the cells to the single streetlights in view
+DETAIL_ZOOM = 16
+
+# Streetlight coordinates sent for the detail view are integers in units of 1e-5 degrees (about 1 m)
+DETAIL_SCALE = 10 ** 5
+
+# Most streetlights a page carries for the detail view, about 120 KB; larger districts send an even sample,
+# so the page size does not grow with the district
+MAX_DETAIL_POINTS = 10000
+
+# Edge length of the aggregation grid in degrees, roughly 350 m x 550 m in Berlin
+CELL_SIZE = 0.005
+
+
+def grid_cells(coords, cell_size=CELL_SIZE):
+    """Bins (lon, lat) coordinates into a regular grid and returns the cells as GeoJSON features with their counts."""
+    cells, counts = np.unique(np.floor(coords / cell_size).astype(np.int64), axis=0, return_counts=True)
+    features = []
+    for (column, row), count in zip(cells.tolist(), counts.tolist()):
+        west, south = column * cell_size, row * cell_size
+        east, north = west + cell_size, south + cell_size
+        features.append({
+            "type": "Feature",
+            "properties": {"count": count, "opacity": round(min(0.9, 0.2 + count / counts.max()), 2)},
+            "geometry": {"type": "Polygon", "coordinates": [[[west, south], [east, south], [east, north], [west, north], [west, south]]]}
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+
+def thin_points(coords, max_points=MAX_DETAIL_POINTS, seed=0):
+    """Returns at most max_points of the coordinates, drawn at random so the sample keeps their density, in their original order."""
+    if len(coords) <= max_points:
+        return coords
+    return coords[np.sort(np.random.default_rng(seed).choice(len(coords), max_points, replace=False))]
+
+
+def quantize_points(coords, scale=DETAIL_SCALE):
+    """Packs (lon, lat) coordinates as integer offsets from their minimum, for a compact detail layer in the page."""
+    origin = np.floor(coords.min(axis=0) * scale) / scale
+    offsets = np.round((coords - origin) * scale).astype(np.int64)
+    return {"origin": origin.tolist(), "scale": scale, "coordinates": offsets.ravel().tolist()}
+
+
+def build_streetlight_lod(streetlights, districts, max_points=MAX_POINTS, cell_size=CELL_SIZE):
+    """Splits the streetlights by district and pre-renders what the map needs at each level of detail.
+
+    Returns {Gemeinde_name: {"count": n, "points": MultiPoint geometry or None, "cells": FeatureCollection,
+    "detail": quantize_points output or None}}. Districts with at most max_points streetlights get "points",
+    drawn at every zoom; larger ones get "detail", drawn instead of the cells from DETAIL_ZOOM on, which
+    holds at most MAX_DETAIL_POINTS of them.
+    """
+    coords = shapely.get_coordinates(streetlights.geometry.values)
+    assignment = district_index.points_by_district(coords, districts, crs=streetlights.crs)
+
+    lod = {}
+    for name in districts['Gemeinde_name'].unique():
+        positions = assignment.loc[assignment["Gemeinde_name"] == name, "point_position"].to_numpy()
+        district_coords = coords[np.sort(positions)]
+        lod[name] = {
+            "count": len(district_coords),
+            "points": {"type": "MultiPoint", "coordinates": district_coords.tolist()} if 0 < len(district_coords) <= max_points else None,
+            "cells": grid_cells(district_coords, cell_size) if len(district_coords) else None,
+            "detail": quantize_points(thin_points(district_coords)) if len(district_coords) > max_points else None
+        }
+    return lod
@@ -0,0 +1,100 @@
+import json
+import argparse
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Local stand-in for the Telraam endpoints used by api_script.py, serving the reports in segment_traffic_data/
+DATA_FOLDER = Path(__file__).parent / 'segment_traffic_data'
+SEGMENTS_FILE = Path(__file__).parent / 'converted_telraam_segments.geojson'
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def load_segments(segments_file, data_folder):
+    """Builds a /v1/segments/all style response with one point per segment that has a report file."""
+    with open(segments_file, 'r') as file:
+        features = json.load(file)['features']
+    available = {path.stem for path in Path(data_folder).glob('*.json')}
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "properties": {"oidn": feature['properties']['segment_id']},
+                "geometry": {"type": "Point", "coordinates": feature['geometry']['coordinates'][0]}
+            }
+            for feature in features if str(feature['properties']['segment_id']) in available
+        ]
+    }
+
+
+class TelraamStubHandler(BaseHTTPRequestHandler):
+    """Answers GET /v1/segments/all and POST /v1/reports/traffic; every `fail_every`-th request gets a 503."""
+
+    server_version = "TelraamStub/1.0"
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def should_fail(self):
+        with self.server.lock:
+            self.server.request_count += 1
+            return self.server.fail_every and self.server.request_count % self.server.fail_every == 0
+
+    def do_GET(self):
+        if self.path != '/v1/segments/all':
+            return self.send_json(404, {"message": "not found"})
+        if self.should_fail():
+            return self.send_json(503, {"message": "try again"})
+        self.send_json(200, self.server.segments)
+
+    def do_POST(self):
+        if self.path != '/v1/reports/traffic':
+            return self.send_json(404, {"message": "not found"})
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        if self.should_fail():
+            return self.send_json(503, {"message": "try again"})
+
+        file_path = Path(self.server.data_folder) / f"{body['id']}.json"
+        if not file_path.exists():
+            return self.send_json(404, {"message": "unknown segment"})
+        with open(file_path, 'r') as file:
+            data = json.load(file)
+
+        start, end = parse_time(body['time_start']), parse_time(body['time_end'])
+        data['report'] = [report for report in data.get('report', []) if start <= parse_time(report['date']) < end]
+        self.send_json(200, data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_server(port=0, data_folder=DATA_FOLDER, segments_file=SEGMENTS_FILE, fail_every=0):
+    """Creates the stub server; port=0 picks a free port, available afterwards as server.server_port."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), TelraamStubHandler)
+    server.data_folder = data_folder
+    server.segments = load_segments(segments_file, data_folder)
+    server.fail_every = fail_every
+    server.request_count = 0
+    server.lock = threading.Lock()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the checked-in Telraam reports through a local copy of the API.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fail-every", type=int, default=0, help="answer every n-th request with a 503 to exercise retries")
+    args = parser.parse_args()
+
+    server = create_server(args.port, fail_every=args.fail_every)
+    print(f"Telraam stub listening on http://127.0.0.1:{server.server_port}")
+    server.serve_forever()
@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+
+from traffic_store import MODES
+
+
+def is_telraam_utc(chars):
+    """Checks that every date looks like "2024-03-28T13:00:00.000Z", so fields can be read at fixed positions."""
+    codes = chars.view(np.uint32).reshape(len(chars), -1)
+    return codes.shape[1] > 12 and (codes[:, 10] == ord('T')).all() and np.char.endswith(chars, 'Z').all()
+
+
+def parse_utc_timestamps(dates):
+    return pd.to_datetime(dates, utc=True, format="ISO8601").tz_localize(None).to_numpy()
+
+
+def parse_utc_hours(dates):
+    """Returns the UTC hour of each ISO 8601 timestamp as an integer array."""
+    chars = np.array(dates)
+    if is_telraam_utc(chars):
+        # Telraam dates are UTC ("...T13:00:00.000Z"), so the hour can be read straight from its two digits
+        codes = chars.view(np.uint32).reshape(len(dates), -1)
+        return (codes[:, 11] - ord('0')).astype(np.int64) * 10 + (codes[:, 12] - ord('0'))
+    timestamps = parse_utc_timestamps(dates).astype('datetime64[h]')
+    return (timestamps - timestamps.astype('datetime64[D]')).astype(np.int64)
+
+
+def parse_utc_days(dates):
+    """Returns the UTC date of each ISO 8601 timestamp as a datetime64[D] array."""
+    chars = np.array(dates)
+    if is_telraam_utc(chars):
+        return chars.astype('U10').astype('datetime64[D]')
+    return parse_utc_timestamps(dates).astype('datetime64[D]')
+
+
+def reports_to_hours_and_values(reports):
+    """Parses a list of Telraam hourly reports in bulk into UTC hours and a reports x modes value array."""
+    hours = parse_utc_hours([report['date'] for report in reports])
+    values = np.array([[report[mode] for report in reports] for mode in MODES], dtype=float).T
+    return hours, values
+
+
+class HourlyAccumulator:
+    """Running per-hour sums and counts of the traffic modes, so means can be updated one batch at a time."""
+
+    def __init__(self):
+        self.sums = np.zeros((24, len(MODES)))
+        self.counts = np.zeros((24, len(MODES)), dtype=np.int64)
+
+    def add(self, reports, sign=1):
+        """Adds a batch of reports; sign=-1 removes a batch that was added before."""
+        if not reports:
+            return self
+        hours, values = reports_to_hours_and_values(reports)
+        present = ~np.isnan(values)
+        # One flat (hour, mode) bin per cell lets a single bincount cover all modes; missing values count as absent
+        bins = (hours[:, None] * len(MODES) + np.arange(len(MODES))).ravel()
+        size = 24 * len(MODES)
+        self.sums += sign * np.bincount(bins, weights=np.where(present, values, 0).ravel(), minlength=size).reshape(24, -1)
+        self.counts += sign * np.bincount(bins[present.ravel()], minlength=size).reshape(24, -1)
+        return self
+
+    def remove(self, reports):
+        return self.add(reports, sign=-1)
+
+    def to_state(self):
+        """Returns the sums and counts as plain lists, e.g. to keep them in a JSON file between runs."""
+        return {"sums": self.sums.tolist(), "counts": self.counts.tolist()}
+
+    @classmethod
+    def from_state(cls, state):
+        accumulator = cls()
+        accumulator.sums = np.array(state["sums"], dtype=float)
+        accumulator.counts = np.array(state["counts"], dtype=np.int64)
+        return accumulator
+
+    def averages(self):
+        """Returns the averages in the {hour: {"avg_car": ..., "avg_bike": ..., "avg_pedestrian": ...}} layout."""
+        means = np.divide(self.sums, self.counts, out=np.zeros_like(self.sums), where=self.counts > 0)
+        return {hour: {f"avg_{mode}": float(means[hour, column]) for column, mode in enumerate(MODES)} for hour in range(24)}
+
+
+class CubeAccumulator:
+    """Running sums and counts by week x day of week x hour x mode, filled one batch of reports at a time."""
+
+    def __init__(self):
+        self.weeks = {}
+
+    def add(self, reports):
+        if not reports:
+            return self
+        hours, values = reports_to_hours_and_values(reports)
+        days = parse_utc_days([report['date'] for report in reports])
+        # 1970-01-01 was a Thursday
+        weekdays = (days.astype(np.int64) + 3) % 7
+        weeks, week_index = np.unique(days - weekdays.astype('timedelta64[D]'), return_inverse=True)
+
+        present = ~np.isnan(values)
+        cells = ((week_index * 7 + weekdays) * 24 + hours)[:, None] * len(MODES) + np.arange(len(MODES))
+        shape = (len(weeks), 7, 24, len(MODES))
+        size = int(np.prod(shape))
+        sums = np.bincount(cells.ravel(), weights=np.where(present, values, 0).ravel(), minlength=size).reshape(shape)
+        counts = np.bincount(cells[present], minlength=size).reshape(shape)
+        for position, week in enumerate(weeks.tolist()):
+            if week in self.weeks:
+                self.weeks[week][0] += sums[position]
+                self.weeks[week][1] += counts[position]
+            else:
+                self.weeks[week] = [sums[position], counts[position]]
+        return self
+
+    def cube(self):
+        """Returns {"weeks": [Monday dates], "sums": ..., "counts": ...} as plain lists, or None without reports."""
+        if not self.weeks:
+            return None
+        weeks = sorted(self.weeks)
+        return {
+            "weeks": [str(week) for week in weeks],
+            "sums": [self.weeks[week][0].tolist() for week in weeks],
+            "counts": [self.weeks[week][1].tolist() for week in weeks],
+        }
+
+
+def traffic_cube(reports):
+    """Returns the reports' sums and counts by week x day of week x hour x mode, with the weeks' Monday dates.
+
+    Days of week run from Monday (0) to Sunday (6) and, like the hours, are in UTC. Any mix of weeks and days
+    of week can be averaged from the cube by summing the selected cells, without going back to the reports.
+    """
+    return CubeAccumulator().add(reports).cube()
+
+
+# Function to process the fetched data
+def process_traffic_data(data):
+    return HourlyAccumulator().add(data.get('report', [])).averages()
@@ -0,0 +1,137 @@
+import os
+
+import numpy as np
+from pathlib import Path
+
+# Order of the last axis of the hourly averages array
+MODES = ["car", "bike", "pedestrian"]
+
+STORE_DIR = Path(__file__).parent / 'traffic_store'
+AVERAGES_FILE = 'hourly_averages.npy'
+SEGMENT_IDS_FILE = 'segment_ids.npy'
+# Sums and counts by segment x week x day of week x hour x mode, and the Monday of every week
+CUBE_SUMS_FILE = 'cube_sums.npy'
+CUBE_COUNTS_FILE = 'cube_counts.npy'
+WEEKS_FILE = 'weeks.npy'
+
+DAYS_OF_WEEK = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def segments_data_to_arrays(segments_data):
+    """Converts {segment_id: {"averages": {hour: {"avg_car": ...}}}} into an id index and a segments x 24 x 3 array."""
+    segment_ids = np.array(sorted(int(segment_id) for segment_id in segments_data), dtype=np.int64)
+    averages = np.full((len(segment_ids), 24, len(MODES)), np.nan)
+
+    for row, segment_id in enumerate(segment_ids):
+        segment = segments_data.get(segment_id, segments_data.get(str(segment_id)))
+        for hour, values in segment['averages'].items():
+            averages[row, int(hour)] = [values.get(f"avg_{mode}", 0) for mode in MODES]
+
+    return segment_ids, averages
+
+
+def segments_data_to_cube(segments_data, segment_ids):
+    """Aligns the per-segment cubes of traffic_aggregation.traffic_cube on one shared axis of weeks.
+
+    Sums are kept as float32 and counts as uint8; a cell holds at most one hourly report per segment.
+    """
+    cubes = [segments_data.get(segment_id, segments_data.get(str(segment_id))).get('cube') for segment_id in segment_ids]
+    weeks = np.array(sorted({week for cube in cubes if cube for week in cube['weeks']}), dtype='datetime64[D]')
+    sums = np.zeros((len(segment_ids), len(weeks), 7, 24, len(MODES)), dtype=np.float32)
+    counts = np.zeros(sums.shape, dtype=np.uint8)
+    for row, cube in enumerate(cubes):
+        if cube:
+            columns = np.searchsorted(weeks, np.array(cube['weeks'], dtype='datetime64[D]'))
+            sums[row, columns] = cube['sums']
+            counts[row, columns] = cube['counts']
+    return weeks, sums, counts
+
+
+def save_arrays(arrays):
+    """Writes {path: array} as .npy files, each through a temporary file that is renamed over it at the end.
+
+    A running app keeps the previous files memory-mapped; rewriting one in place would truncate the pages under
+    the map (a bus error on the next read), while a rename leaves the old file readable until it is unmapped.
+    All files are written before the first rename, so a store opened during a refresh can only mix the old
+    and new files within the few renames.
+    """
+    temp_paths = {}
+    for file_path, array in arrays.items():
+        temp_paths[file_path] = file_path.with_name(file_path.name + '.tmp')
+        with open(temp_paths[file_path], 'wb') as file:
+            np.save(file, array)
+    for file_path, temp_path in temp_paths.items():
+        os.replace(temp_path, file_path)
+
+
+def write_traffic_store(segments_data, store_dir=STORE_DIR):
+    """Writes the hourly averages, and the cube when the segments have one, as plain .npy files that readers can memory-map.
+
+    Stores already open keep reading the data they were opened with.
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    segment_ids, averages = segments_data_to_arrays(segments_data)
+    arrays = {store_dir / SEGMENT_IDS_FILE: segment_ids, store_dir / AVERAGES_FILE: averages}
+
+    cube_files = [store_dir / WEEKS_FILE, store_dir / CUBE_SUMS_FILE, store_dir / CUBE_COUNTS_FILE]
+    has_cube = any('cube' in segment for segment in segments_data.values())
+    if has_cube:
+        arrays.update(zip(cube_files, segments_data_to_cube(segments_data, segment_ids)))
+    save_arrays(arrays)
+    if not has_cube:
+        # A cube from an older run would no longer match the segment ids
+        for file_path in cube_files:
+            file_path.unlink(missing_ok=True)
+    return store_dir
+
+
+class TrafficStore:
+    """Read-only view of the hourly traffic averages, memory-mapped from the files written by write_traffic_store."""
+
+    def __init__(self, store_dir=STORE_DIR):
+        store_dir = Path(store_dir)
+        self.segment_ids = np.load(store_dir / SEGMENT_IDS_FILE)
+        self.averages = np.load(store_dir / AVERAGES_FILE, mmap_mode='r')
+        self._rows = {int(segment_id): row for row, segment_id in enumerate(self.segment_ids)}
+        self.weeks = self.cube_sums = self.cube_counts = None
+        if (store_dir / CUBE_SUMS_FILE).exists():
+            self.weeks = np.load(store_dir / WEEKS_FILE)
+            self.cube_sums = np.load(store_dir / CUBE_SUMS_FILE, mmap_mode='r')
+            self.cube_counts = np.load(store_dir / CUBE_COUNTS_FILE, mmap_mode='r')
+
+    @property
+    def has_cube(self):
+        return self.cube_sums is not None
+
+    def __contains__(self, segment_id):
+        return int(segment_id) in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def week_mask(self, weeks):
+        """Selects the weeks whose Monday lies in the inclusive (first, last) range of ISO dates."""
+        first, last = (np.datetime64(week, 'D') for week in weeks)
+        return (self.weeks >= first) & (self.weeks <= last)
+
+    def hourly_averages(self, segment_id, hour, weekdays=None, weeks=None):
+        """Returns {"avg_car": ..., "avg_bike": ..., "avg_pedestrian": ...} for one segment and hour, or None if unknown.
+
+        weekdays (0 = Monday) and weeks (a (first, last) range of week Mondays) narrow the average down;
+        they are answered by slicing the cube, so they need a store written with one.
+        """
+        row = self._rows.get(int(segment_id))
+        if row is None:
+            return None
+        if weekdays is None and weeks is None:
+            values = self.averages[row, int(hour)]
+        else:
+            week_columns = self.week_mask(weeks) if weeks is not None else slice(None)
+            day_columns = list(weekdays) if weekdays is not None else slice(None)
+            sums = self.cube_sums[row, week_columns][:, day_columns, int(hour)].sum(axis=(0, 1), dtype=np.float64)
+            counts = self.cube_counts[row, week_columns][:, day_columns, int(hour)].sum(axis=(0, 1), dtype=np.int64)
+            values = np.divide(sums, counts, out=np.full(len(MODES), np.nan), where=counts > 0)
+        if np.isnan(values).all():
+            return None
+        return {f"avg_{mode}": float(value) for mode, value in zip(MODES, values)}
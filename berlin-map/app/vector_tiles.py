@@ -0,0 +1,315 @@
+import json
+import math
+import argparse
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from branca.element import MacroElement
+from folium.plugins import VectorGridProtobuf
+from jinja2 import Template
+
+import district_index
+import traffic_store
+
+TILES_DIR = Path(__file__).parent / 'static' / 'tiles'
+# Where Streamlit's static file serving (see .streamlit/config.toml) exposes TILES_DIR
+TILES_URL = "/app/static/tiles"
+
+MIN_ZOOM = 10
+MAX_ZOOM = 15
+EXTENT = 4096
+# Grid that point layers without properties are thinned to, per tile side
+POINT_RESOLUTION = 256
+
+# Bumped whenever the tiles' contents change, so the app ignores a pyramid written by older code
+FORMAT_VERSION = 2
+
+# Half the width of the Web Mercator world, in metres
+ORIGIN_SHIFT = math.pi * 6378137
+
+TILE_LAYERS = ["districts", "traffic_segments", "streetlights", "police_precincts"]
+
+STYLES = {
+    "districts": {"color": "#3388ff", "weight": 3, "fill": True, "fillOpacity": 0.2},
+    "traffic_segments": {"color": "blue", "weight": 5},
+    "streetlights": {"radius": 1, "color": "yellow", "fill": True, "fillColor": "yellow", "fillOpacity": 1},
+    "police_precincts": {"radius": 6, "color": "red", "fill": True, "fillColor": "red", "fillOpacity": 0.8},
+}
+
+# Popup contents as JavaScript expressions over the clicked feature's properties `p`
+POPUPS = {
+    "traffic_segments": (
+        "'Segment ID: ' + p.segment_id + '<br>Hour: {hour}<br>'"
+        " + 'Cars: ' + Math.round(p.car_{hour}) + '<br>Bikes: ' + Math.round(p.bike_{hour}) + '<br>'"
+        " + 'Pedestrians: ' + Math.round(p.pedestrian_{hour}) + '<br>'"
+    ),
+    "police_precincts": (
+        "'<b>Police Precinct</b><br><b>Address:</b> ' + p.text + ', ' + p.locatorDesignator + ', ' + p.postCode + '<br>'"
+        " + '<b>Phone:</b> ' + p.telephoneVoice + '<br>'"
+        " + '<b>Website:</b> <a href=\"' + p.website + '\" target=\"_blank\">' + p.website + '</a><br>'"
+    ),
+}
+
+
+def tile_bounds(x, y, z):
+    """Returns the Web Mercator (EPSG:3857) bounds of tile x/y at zoom z, in the XYZ scheme Leaflet uses."""
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    west = -ORIGIN_SHIFT + x * size
+    north = ORIGIN_SHIFT - y * size
+    return west, north - size, west + size, north
+
+
+def tiles_covering(bounds, z):
+    """Yields the x, y of every tile at zoom z that intersects the given EPSG:3857 bounds."""
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    minx, miny, maxx, maxy = bounds
+    for x in range(int((minx + ORIGIN_SHIFT) // size), int((maxx + ORIGIN_SHIFT) // size) + 1):
+        for y in range(int((ORIGIN_SHIFT - maxy) // size), int((ORIGIN_SHIFT - miny) // size) + 1):
+            yield x, y
+
+
+def simplify_tolerance(z):
+    """Returns half a tile unit at zoom z in metres; detail finer than that cannot show up in the tile."""
+    return 2 * ORIGIN_SHIFT / 2 ** z / EXTENT / 2
+
+
+def json_safe(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    return value if isinstance(value, (str, int, float, bool)) else str(value)
+
+
+def district_labels(assignment, count):
+    """Joins the (row position, Gemeinde_name) pairs into one "|name|name|" string per row, for the tile filters."""
+    labels = [""] * count
+    for row_position, name in assignment.sort_values(list(assignment.columns)).itertuples(index=False):
+        labels[row_position] += f"|{name}|" if not labels[row_position] else f"{name}|"
+    return labels
+
+
+def tile_layer_sources(districts, police_precincts, traffic_geojson, streetlights, segment_data):
+    """Returns {tile layer name: GeoDataFrame in EPSG:3857} with the properties each layer's popups need.
+
+    Every feature carries the districts it is drawn in on a district map as a "|name|" string, assigned the
+    same way as the inline layers' partitions; features outside every district are left out. Like the inline
+    traffic layer, segments without averages are left out and hours without averages are empty strings.
+    streetlights may be None, which leaves their layer out.
+    """
+    segments = gpd.GeoDataFrame.from_features(traffic_geojson['features'], crs="EPSG:4326")
+    segments = segments[[str(segment_id) in segment_data for segment_id in segments['segment_id']]].reset_index(drop=True)
+    segment_properties = []
+    for segment_id in segments['segment_id']:
+        properties = {"segment_id": int(segment_id)}
+        for hour in range(24):
+            averages = segment_data.hourly_averages(str(segment_id), hour)
+            for mode in traffic_store.MODES:
+                properties[f"{mode}_{hour}"] = averages[f"avg_{mode}"] if averages else ""
+        segment_properties.append(properties)
+    segments = gpd.GeoDataFrame(segment_properties, geometry=segments.geometry.values, crs="EPSG:4326")
+    segments["districts"] = district_labels(district_index.vertices_by_district(segments, districts), len(segments))
+
+    police_columns = ["text", "locatorDesignator", "postCode", "telephoneVoice", "website"]
+    police_precincts = police_precincts[police_columns + ["geometry"]].reset_index(drop=True)
+    police_assignment = gpd.sjoin(police_precincts, districts[["Gemeinde_name", "geometry"]], how="inner", predicate="within")
+    police_precincts["districts"] = district_labels(
+        police_assignment.reset_index()[["index", "Gemeinde_name"]], len(police_precincts)
+    )
+
+    district_outlines = districts[["Gemeinde_name", "geometry"]].copy()
+    district_outlines["districts"] = [f"|{name}|" for name in district_outlines["Gemeinde_name"]]
+    sources = {
+        "districts": district_outlines,
+        "traffic_segments": segments[segments["districts"] != ""],
+        "police_precincts": police_precincts[police_precincts["districts"] != ""],
+    }
+
+    if streetlights is not None:
+        coords = shapely.get_coordinates(streetlights.geometry.values)
+        light_assignment = district_index.points_by_district(coords, districts, crs=streetlights.crs)
+        sources["streetlights"] = gpd.GeoDataFrame(
+            {"districts": [f"|{name}|" for name in light_assignment["Gemeinde_name"]]},
+            geometry=gpd.points_from_xy(*coords[light_assignment["point_position"].to_numpy()].T),
+            crs=streetlights.crs
+        )
+    return {name: source.to_crs("EPSG:3857") for name, source in sources.items()}
+
+
+def is_bare_point_layer(source):
+    """Point layers with no property besides their districts, such as the streetlights, are tiled straight
+    from a coordinate array."""
+    return set(source.columns) == {"districts", "geometry"} and set(source.geom_type.unique()) <= {"Point", "MultiPoint"}
+
+
+def point_tiles(coords, labels, z):
+    """Groups EPSG:3857 coordinates by the tile they fall in at zoom z and yields x, y and the tile's coordinates and labels."""
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    columns = ((coords[:, 0] + ORIGIN_SHIFT) // size).astype(np.int64)
+    rows = ((ORIGIN_SHIFT - coords[:, 1]) // size).astype(np.int64)
+    order = np.lexsort((rows, columns))
+    tiles, starts = np.unique(np.column_stack([columns, rows])[order], axis=0, return_index=True)
+    for (x, y), tile_coords, tile_labels in zip(tiles.tolist(), np.split(coords[order], starts[1:]), np.split(labels[order], starts[1:])):
+        yield x, y, tile_coords, tile_labels
+
+
+def encode_point_tile(name, coords, labels, x, y, z, resolution=POINT_RESOLUTION):
+    """Encodes the coordinates of tile x/y/z as one MultiPoint per district label.
+
+    Points sharing a cell of a resolution x resolution grid over the tile are merged, which keeps low-zoom
+    tiles of dense layers (e.g. all streetlights of Berlin) bounded in size.
+    """
+    bounds = tile_bounds(x, y, z)
+    cell_size = (bounds[2] - bounds[0]) / resolution
+    origin = np.array(bounds[:2])
+    features = []
+    for label in np.unique(labels).tolist():
+        cells = np.unique(np.floor((coords[labels == label] - origin) / cell_size), axis=0)
+        features.append({"geometry": shapely.multipoints((cells + 0.5) * cell_size + origin), "properties": {"districts": label}})
+    import mapbox_vector_tile
+    return mapbox_vector_tile.encode(
+        [{"name": name, "features": features}],
+        default_options={"quantize_bounds": bounds, "extents": EXTENT}
+    )
+
+
+def encode_tile(name, source, simplified, x, y, z):
+    """Encodes the features of one layer that fall in tile x/y/z, or returns None if there are none."""
+    bounds = tile_bounds(x, y, z)
+    # A small buffer keeps lines and polygon outlines from ending exactly at the tile edge
+    buffer = (bounds[2] - bounds[0]) / 64
+    clip_bounds = (bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+    positions = source.sindex.query(shapely.box(*clip_bounds))
+    if len(positions) == 0:
+        return None
+
+    clipped = shapely.clip_by_rect(simplified[positions], *clip_bounds)
+    columns = source.drop(columns="geometry")
+    # to_dict gives no records at all for a frame without columns, such as the streetlights
+    properties = columns.iloc[positions].to_dict('records') if len(columns.columns) else [{}] * len(positions)
+    features = [
+        {"geometry": geometry, "properties": {key: json_safe(value) for key, value in row.items()}}
+        for geometry, row in zip(clipped, properties) if not geometry.is_empty
+    ]
+    if not features:
+        return None
+    # Only needed to build the pyramid, the app itself just serves the files
+    import mapbox_vector_tile
+    return mapbox_vector_tile.encode(
+        [{"name": name, "features": features}],
+        default_options={"quantize_bounds": bounds, "extents": EXTENT}
+    )
+
+
+def build_tiles(sources, output_dir=TILES_DIR, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    """Writes a {layer}/{z}/{x}/{y}.pbf pyramid, simplifying the geometries separately for every zoom level."""
+    output_dir = Path(output_dir)
+    written = {}
+    for name, source in sources.items():
+        count = 0
+        coords = labels = None
+        if is_bare_point_layer(source):
+            coords, positions = shapely.get_coordinates(source.geometry.values, return_index=True)
+            labels = source["districts"].to_numpy()[positions]
+        for z in range(min_zoom, max_zoom + 1):
+            if coords is not None:
+                tiles = (
+                    (x, y, encode_point_tile(name, tile_coords, tile_labels, x, y, z))
+                    for x, y, tile_coords, tile_labels in point_tiles(coords, labels, z)
+                )
+            else:
+                simplified = shapely.simplify(source.geometry.values, simplify_tolerance(z), preserve_topology=True)
+                tiles = ((x, y, encode_tile(name, source, simplified, x, y, z)) for x, y in tiles_covering(source.total_bounds, z))
+            for x, y, tile in tiles:
+                if tile is None:
+                    continue
+                tile_path = output_dir / name / str(z) / str(x) / f"{y}.pbf"
+                tile_path.parent.mkdir(parents=True, exist_ok=True)
+                tile_path.write_bytes(tile)
+                count += 1
+        written[name] = count
+    with open(output_dir / 'metadata.json', 'w') as file:
+        json.dump({"format_version": FORMAT_VERSION, "min_zoom": min_zoom, "max_zoom": max_zoom, "tiles": written}, file)
+    return written
+
+
+def tiles_available(tiles_dir=TILES_DIR):
+    """Whether a pyramid in the format this code draws has been generated."""
+    metadata_path = Path(tiles_dir) / 'metadata.json'
+    if not metadata_path.exists():
+        return False
+    with open(metadata_path, 'r') as file:
+        return json.load(file).get("format_version") == FORMAT_VERSION
+
+
+class TilePopup(MacroElement):
+    """Opens a popup with the clicked vector tile feature's properties."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            {{ this._parent.get_name() }}.on('click', function(e) {
+                var p = e.layer.properties;
+                L.popup({maxWidth: 500}).setLatLng(e.latlng).setContent({{ this.content }}).openOn({{ this.map_name }});
+            });
+        {% endmacro %}
+    """)
+
+    def __init__(self, content, map_name):
+        super().__init__()
+        self._name = "TilePopup"
+        self.content = content
+        self.map_name = map_name
+
+
+def tile_style(name, selected_district=None, selected_hour=None):
+    """Returns a JavaScript style function that hides the features the inline layer would not draw.
+
+    Those are the features outside selected_district and, for the traffic segments, the ones without
+    averages at selected_hour; VectorGrid skips features whose style is an empty list.
+    """
+    conditions = []
+    if selected_district is not None:
+        conditions.append(f"p.districts.indexOf({json.dumps(f'|{selected_district}|')}) >= 0")
+    if name == "traffic_segments":
+        conditions.append(f"p.car_{selected_hour} !== ''")
+    condition = " && ".join(conditions) or "true"
+    return f"function(p) {{ return ({condition}) ? {json.dumps(STYLES[name])} : []; }}"
+
+
+def add_tile_layer(m, name, selected_district=None, selected_hour=None):
+    """Adds one layer of the pre-generated pyramid to a folium map, with popups where the layer has them.
+
+    On a district map only the features of selected_district are drawn, as with the inline layers.
+    """
+    # A string, because the style function has to reach the page as JavaScript rather than JSON
+    options = (
+        f'{{"interactive": {json.dumps(name in POPUPS)}, "maxNativeZoom": {MAX_ZOOM}, '
+        f'"vectorTileLayerStyles": {{{json.dumps(name)}: {tile_style(name, selected_district, selected_hour)}}}}}'
+    )
+    layer = VectorGridProtobuf(f"{TILES_URL}/{name}/{{z}}/{{x}}/{{y}}.pbf", name=name, options=options)
+    layer.add_to(m)
+    if name in POPUPS:
+        TilePopup(POPUPS[name].replace("{hour}", str(selected_hour)), m.get_name()).add_to(layer)
+    return layer
+
+
+if __name__ == '__main__':
+    import map_layers
+
+    parser = argparse.ArgumentParser(description="Pre-generate Mapbox vector tiles for the map layers.")
+    parser.add_argument("--output-dir", default=TILES_DIR, help="directory the tile pyramid is written to")
+    parser.add_argument("--min-zoom", type=int, default=MIN_ZOOM)
+    parser.add_argument("--max-zoom", type=int, default=MAX_ZOOM)
+    args = parser.parse_args()
+
+    districts = gpd.read_file(map_layers.DISTRICTS_FILE)
+    with open(map_layers.TRAFFIC_FILE, 'r') as file:
+        traffic_geojson = json.load(file)
+    sources = tile_layer_sources(
+        districts,
+        map_layers.load_police_precincts(),
+        traffic_geojson,
+        map_layers.load_streetlights(),
+        traffic_store.TrafficStore(map_layers.TRAFFIC_STORE_DIR)
+    )
+    print(build_tiles(sources, args.output_dir, args.min_zoom, args.max_zoom))
@@ -0,0 +1,50 @@
+#!/bin/sh
+# Starts WORKERS Streamlit processes serving the read-only artifacts behind nginx on PORT.
+# With WORKERS=1 a single Streamlit process listens on PORT itself.
+set -e
+
+WORKERS=${WORKERS:-1}
+PORT=${PORT:-8501}
+BASE_PORT=${BASE_PORT:-8601}
+# With timings on, worker i serves its metrics on BASE_METRICS_PORT + i, since only one process can bind a port
+BASE_METRICS_PORT=${BASE_METRICS_PORT:-${BERLIN_MAP_METRICS_PORT:-0}}
+DEPLOY_DIR=$(cd "$(dirname "$0")" && pwd)
+APP_DIR=${APP_DIR:-$DEPLOY_DIR/../app}
+RUN_DIR=${RUN_DIR:-/tmp/berlin-map}
+export BERLIN_MAP_ARTIFACTS=${BERLIN_MAP_ARTIFACTS:-$APP_DIR/artifacts}
+
+cd "$APP_DIR"
+
+# Derive everything once, so the workers only read and memory-map it
+if [ ! -f "$BERLIN_MAP_ARTIFACTS/manifest.json" ]; then
+    python3 artifacts.py --output-dir "$BERLIN_MAP_ARTIFACTS"
+fi
+
+if [ "$WORKERS" -le 1 ]; then
+    exec streamlit run app.py --server.headless true --server.port "$PORT"
+fi
+
+mkdir -p "$RUN_DIR"
+PIDS=""
+trap 'kill $PIDS 2>/dev/null' EXIT INT TERM
+
+: > "$RUN_DIR/upstream.conf"
+i=0
+while [ "$i" -lt "$WORKERS" ]; do
+    WORKER_PORT=$((BASE_PORT + i))
+    if [ "$BASE_METRICS_PORT" -gt 0 ]; then
+        export BERLIN_MAP_METRICS_PORT=$((BASE_METRICS_PORT + i))
+    fi
+    streamlit run app.py --server.headless true --server.port "$WORKER_PORT" --server.address 127.0.0.1 \
+        > "$RUN_DIR/worker-$i.log" 2>&1 &
+    PIDS="$PIDS $!"
+    echo "server 127.0.0.1:$WORKER_PORT;" >> "$RUN_DIR/upstream.conf"
+    i=$((i + 1))
+done
+
+sed -e "s|@PORT@|$PORT|" -e "s|@UPSTREAM_FILE@|$RUN_DIR/upstream.conf|" \
+    "$DEPLOY_DIR/nginx.conf.template" > "$RUN_DIR/nginx.conf"
+echo "Serving $WORKERS workers on port $PORT, worker logs in $RUN_DIR"
+nginx -c "$RUN_DIR/nginx.conf" -g 'daemon off;' &
+PIDS="$PIDS $!"
+wait
@@ -0,0 +1,93 @@
+import time
+import random
+from urllib.parse import urlencode, urlparse
+
+import gevent
+import websocket
+from gevent.queue import Queue
+from locust import User, task, between, events
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+DISTRICTS = ["Mitte", "Friedrichshain-Kreuzberg", "Pankow", "Charlottenburg-Wilmersdorf", "Spandau", "Steglitz-Zehlendorf", "Tempelhof-Schöneberg", "Neukölln", "Treptow-Köpenick", "Marzahn-Hellersdorf", "Lichtenberg", "Reinickendorf"]
+LAYERS = ["Crime Heat Map", "Crime Data", "Traffic Data", "Police Precincts"]
+
+# Longest a rerun may take before it is counted as a failure
+TIMEOUT = 60
+
+
+class MapUser(User):
+    """A browser tab: one Streamlit session that keeps switching to a random district, layer and hour.
+
+    Every switch is one rerun over the session's websocket, timed from sending it until the app reports
+    that the script finished, which includes receiving the map page.
+    """
+
+    wait_time = between(1, 3)
+
+    def on_start(self):
+        host = urlparse(self.host)
+        scheme = "wss" if host.scheme == "https" else "ws"
+        self.url = f"{scheme}://{host.netloc}/_stcore/stream"
+        self.connect()
+
+    def connect(self):
+        self.ws = websocket.create_connection(self.url, subprotocols=["streamlit"])
+        self.messages = Queue()
+        self.receiver = gevent.spawn(self.receive, self.ws, self.messages)
+
+    @staticmethod
+    def receive(ws, messages):
+        """Reads the socket all the time, like a browser, so the server's pings are answered between reruns too."""
+        try:
+            while True:
+                opcode, message = ws.recv_data()
+                if opcode == websocket.ABNF.OPCODE_BINARY:
+                    messages.put(message)
+        except Exception as e:
+            messages.put(e)
+
+    def on_stop(self):
+        self.receiver.kill()
+        self.ws.close()
+
+    def rerun(self, name, query):
+        back_msg = BackMsg()
+        back_msg.rerun_script.query_string = urlencode(query)
+        start = time.perf_counter()
+        length = 0
+        exception = None
+        try:
+            self.ws.send_binary(back_msg.SerializeToString())
+            while True:
+                message = self.messages.get(timeout=TIMEOUT)
+                if isinstance(message, Exception):
+                    raise message
+                length += len(message)
+                forward_msg = ForwardMsg()
+                forward_msg.ParseFromString(message)
+                if forward_msg.WhichOneof("type") == "script_finished":
+                    if forward_msg.script_finished != ForwardMsg.FINISHED_SUCCESSFULLY:
+                        exception = RuntimeError(ForwardMsg.ScriptFinishedStatus.Name(forward_msg.script_finished))
+                    break
+        except Exception as e:
+            exception = e
+            # Start over with a fresh session rather than reading the rest of the failed rerun
+            self.on_stop()
+            self.connect()
+        events.request.fire(
+            request_type="rerun",
+            name=name,
+            response_time=(time.perf_counter() - start) * 1000,
+            response_length=length,
+            exception=exception,
+            context={},
+        )
+
+    @task
+    def switch_map(self):
+        layer = random.choice(LAYERS)
+        query = {"district": random.choice(DISTRICTS), "layer": layer}
+        if layer == "Traffic Data":
+            query["hour"] = random.randrange(24)
+        self.rerun(layer, query)
@@ -0,0 +1,33 @@
+#!/bin/sh
+# Runs the same load test against 1, 4 and 8 workers and prints requests/second and p95 latency of each.
+set -e
+
+USERS=${USERS:-50}
+SPAWN_RATE=${SPAWN_RATE:-10}
+RUN_TIME=${RUN_TIME:-2m}
+PORT=${PORT:-8501}
+WORKER_COUNTS=${WORKER_COUNTS:-"1 4 8"}
+LOADTEST_DIR=$(cd "$(dirname "$0")" && pwd)
+RESULTS_DIR=${RESULTS_DIR:-$LOADTEST_DIR/results}
+
+mkdir -p "$RESULTS_DIR"
+for WORKERS in $WORKER_COUNTS; do
+    WORKERS=$WORKERS PORT=$PORT sh "$LOADTEST_DIR/../deploy/run_workers.sh" > "$RESULTS_DIR/workers-$WORKERS.log" 2>&1 &
+    SERVER=$!
+    # Wait until every worker has come up behind the load balancer
+    until curl -sf "http://localhost:$PORT/_stcore/health" > /dev/null; do sleep 1; done
+    sleep 5
+
+    locust -f "$LOADTEST_DIR/locustfile.py" --headless --host "http://localhost:$PORT" \
+        --users "$USERS" --spawn-rate "$SPAWN_RATE" --run-time "$RUN_TIME" \
+        --csv "$RESULTS_DIR/workers-$WORKERS" --only-summary > /dev/null 2>&1 || true
+
+    kill "$SERVER"
+    wait "$SERVER" 2>/dev/null || true
+
+    # Look the columns up by their header, since locust's percentile columns depend on its settings
+    awk -F, -v workers="$WORKERS" '
+        NR == 1 { for (i = 1; i <= NF; i++) column[$i] = i }
+        $2 == "Aggregated" { printf "%d workers: %.1f requests/s, p95 %s ms\n", workers, $column["Requests/s"], $column["95%"] }' \
+        "$RESULTS_DIR/workers-${WORKERS}_stats.csv"
+done